@@ -0,0 +1,661 @@
+import weakref
+import mal_types as types
+import core
+import macros
+from macros import quasiquote, unquote_Q, is_macro_call, macroexpand, define
+import forms
+from forms import Tail
+from env import Env
+from mal_types import List, Vector, Hash_Map, MalException
+
+# Analyze-then-execute evaluator: each form is analyzed once into a tree
+# of Python closures taking a frame. Closures in tail position return a
+# TailCall instead of calling a mal function so that _run/fn can loop
+# (TCO) without growing the Python stack.
+#
+# Local bindings are resolved at analysis time to frame addresses.
+# Each fn* call (and each top-level form) gets one frame: a list whose
+# slot 0 holds the closure's captured variables and whose other slots
+# hold the parameters and every let*/catch*/def! binding in the body.
+# Names that are not bound lexically are looked up in the global Env at
+# run time, so def! and eval at the top level can still introduce them
+# dynamically.
+
+class TailCall(object):
+    __slots__ = ('body', 'frame')
+    def __init__(self, body, frame):
+        self.body = body
+        self.frame = frame
+
+def _run(body, frame):
+    ret = body(frame)
+    while type(ret) is TailCall:
+        ret = ret.body(ret.frame)
+    return ret
+
+# Functions
+# An analyzed fn* form. The body is analyzed on the first call, once the
+# enclosing let*/def! bindings it may refer to (and any macros it uses)
+# have all been defined, in a scope of its own holding the parameters
+# and the captures planned when the first closure was made. Macro calls
+# in it are expanded then, so it is analyzed again on the next call
+# after a macro is defined or redefined (macros.macro_version changes).
+class Lambda(object):
+    __slots__ = ('ast', 'params', 'nparams', 'rest', 'genv', 'captures',
+                 'body', 'pad', 'getters', 'version')
+    def __init__(self, ast, params, nparams, rest, genv, captures=None):
+        self.ast = ast
+        self.params = params
+        self.nparams = nparams
+        self.rest = rest
+        self.genv = genv
+        self.captures = captures
+        self.body = None
+        self.getters = None
+        self.version = None
+
+    # saved as its source: the body is analyzed again on its first call
+    def __reduce__(self):
+        return (Lambda, (self.ast, self.params, self.nparams, self.rest,
+                         self.genv, self.captures))
+
+    def analyze(self):
+        self.version = macros.macro_version
+        scope = Scope(names=self.params, genv=self.genv, frame=True)
+        scope.captures = self.captures
+        self.body = analyze(self.ast, scope, True)
+        self.pad = [None] * (scope.size - 1 - len(self.params))
+
+def _function(lam, captured):
+    nparams, rest = lam.nparams, lam.rest
+    def gen_frame(args):
+        if lam.version != macros.macro_version: lam.analyze()
+        frame = [captured]
+        if len(args) == nparams and not rest:
+            frame.extend(args)
+        else:
+            frame.extend(args[:nparams])
+            frame.extend([None] * (nparams - len(args)))
+            if rest: frame.append(List(args[nparams:]))
+        frame.extend(lam.pad)
+        return frame
+    def fn(*args):
+        frame = gen_frame(args)
+        ret = lam.body(frame)
+        while type(ret) is TailCall:
+            ret = ret.body(ret.frame)
+        return ret
+    fn.__meta__ = None
+    fn.__lambda__ = lam
+    fn.__captured__ = captured
+    fn.__gen_frame__ = gen_frame
+    return fn
+
+def _macro(fn):
+    func = types._clone(fn)
+    func._ismacro_ = True
+    return func
+
+# Compile-time scope. A scope created with frame=True owns a run-time
+# frame (fn* bodies and top-level forms); let* and catch* open block
+# scopes that allocate their slots in the enclosing frame. A frame scope
+# made without an outer scope is a top-level form's, unless it is the
+# scope of a fn* body being analyzed.
+#
+# Addresses are (LOCAL, idx) for slot idx of the current frame,
+# (CAPTURED, k) for the value at position k of the closure's captured
+# variables and (LATE, k) for the Cell at position k. Lookups never go
+# past the enclosing fn*: its outer bindings are only visible through
+# its captures.
+LOCAL, CAPTURED, LATE = range(3)
+
+# A slot that closures capture late is mirrored in a Cell, made when the
+# first such closure is created and kept in a slot of its own. Stores to
+# the slot update the cell, so the closures see the current value
+# without holding the rest of the frame.
+class Cell(object):
+    __slots__ = ('val',)
+    def __init__(self, val):
+        self.val = val
+
+def _set_cell(f, late, idx):
+    cidx = late.get(idx)
+    if cidx is not None and f[cidx] is not None:
+        f[cidx].val = f[idx]
+
+# Each run of a let*, loop iteration or catch* binds its slots afresh, so
+# the cells of the late slots in its span [start, end) of the frame are
+# dropped: closures made by an earlier run keep the cells they hold
+def _reset_cells(f, late, span):
+    start, end = span
+    for idx, cidx in late.items():
+        if start <= idx < end: f[cidx] = None
+
+class Scope():
+    def __init__(self, outer=None, names=(), genv=None, frame=False):
+        self.outer = outer
+        self.names = {}
+        self.genv = genv if outer is None else outer.genv
+        self.recur = None
+        self.pending = {}
+        self.toplevel = outer is None and not frame
+        if frame or outer is None:
+            self.frame = self
+            self.size = 1
+            self.captures = {}
+            # slot -> slot of its Cell, names the closures made here use
+            self.late = {}
+            self.closure_refs = set()
+        else:
+            self.frame = outer.frame
+        for n in names: self.bind(n, self.reserve(n))
+
+    # allocate the slot for key without making it visible yet, so that
+    # the binding's own value expression still sees the outer binding.
+    # A closure analyzed earlier that uses the name sees it late.
+    def reserve(self, key):
+        if key in self.names:
+            idx = self.names[key]
+        else:
+            self.frame.size += 1
+            idx = self.frame.size - 1
+        if key in self.frame.closure_refs:
+            self.make_late(idx)
+        self.pending[key] = idx
+        return idx
+
+    def bind(self, key, idx):
+        self.pending.pop(key, None)
+        self.names[key] = idx
+
+    def make_late(self, idx):
+        frame = self.frame
+        if idx not in frame.late:
+            frame.late[idx] = frame.size
+            frame.size += 1
+
+    def lookup(self, key):
+        scope = self
+        while True:
+            if key in scope.names:
+                return LOCAL, scope.names[key]
+            if scope.frame is scope:
+                return scope.captures.get(key)
+            scope = scope.outer
+
+    # the slots a recur here rebinds, and the span of the frame the loop
+    # allocated: those of the innermost loop in the same frame
+    def recur_target(self):
+        scope = self
+        while scope:
+            if scope.recur is not None: return scope.recur
+            if scope.frame is scope:    return None
+            scope = scope.outer
+        return None
+
+    def is_toplevel(self):
+        return self.toplevel
+
+# Quasiquote templates compile straight to closures building the result
+# instead of analyzing the equivalent cons/concat expansion
+def qq_const_Q(ast):
+    if unquote_Q(ast, u'unquote') or unquote_Q(ast, u'splice-unquote'):
+        return False
+    elif types._list_Q(ast) or types._vector_Q(ast):
+        return all(qq_const_Q(elt) for elt in ast)
+    else:
+        return True
+
+def qq_analyze(ast, scope, tail=False):
+    if unquote_Q(ast, u'unquote'):
+        return analyze(ast[1], scope, tail)
+    elif qq_const_Q(ast):
+        return lambda f: ast
+    typ = List if types._list_Q(ast) else Vector
+    parts = [(True, analyze(elt[1], scope))
+             if unquote_Q(elt, u'splice-unquote')
+             else (False, qq_analyze(elt, scope)) for elt in ast]
+    def build(f):
+        lst = []
+        for splice, exe in parts:
+            if splice: lst.extend(exe(f))
+            else:      lst.append(exe(f))
+        return typ(lst)
+    return build
+
+# Expand at analysis time: locally bound heads are never macros here
+def analyze_macroexpand(ast, scope):
+    while (types._list_Q(ast) and types._symbol_Q(ast[0]) and
+           scope.lookup(ast[0]) is None and is_macro_call(ast, scope.genv)):
+        mac = scope.genv.get(ast[0])
+        ast = mac(*ast[1:])
+    return ast
+
+# analysis
+def analyze_symbol(sym, scope):
+    addr = scope.lookup(sym)
+    if addr is None:
+        genv = scope.genv
+        if genv.outer: return lambda f: genv.get(sym)
+        data = genv.data
+        def glob(f):
+            try:
+                return data[sym]
+            except KeyError:
+                raise Exception("'" + sym + "' not found")
+        return glob
+    if addr[0] == LOCAL:
+        idx = addr[1]
+        return lambda f: f[idx]
+    elif addr[0] == CAPTURED:
+        k = addr[1]
+        return lambda f: f[0][k]
+    k = addr[1]
+    return lambda f: f[0][k].val
+
+def analyze(ast, scope, tail=False):
+    if types._symbol_Q(ast):
+        return analyze_symbol(ast, scope)
+    elif types._vector_Q(ast):
+        items = [analyze(a, scope) for a in ast]
+        return lambda f: Vector([i(f) for i in items])
+    elif types._hash_map_Q(ast):
+        items = [(k, analyze(v, scope)) for k, v in ast.items()]
+        return lambda f: Hash_Map((k, v(f)) for k, v in items)
+    elif not types._list_Q(ast):
+        return lambda f: ast  # primitive value, return unchanged
+
+    # apply list
+    try:
+        ast = analyze_macroexpand(ast, scope)
+        if not types._list_Q(ast):
+            return analyze(ast, scope, tail)
+        if len(ast) == 0:
+            return lambda f: ast
+        a0 = ast[0]
+        if types._symbol_Q(a0) and a0 in special_forms:
+            return special_forms[a0](ast, scope, tail)
+        if types._symbol_Q(a0) and a0 in forms.special_forms:
+            return analyze_host_form(forms.special_forms[a0], ast, scope)
+        return analyze_call(ast, scope, tail)
+    except Exception as exc:
+        # errors found while analyzing a form (including those thrown by
+        # macros) are raised when it runs, where try*/catch* sees them
+        def error(f, exc=exc): raise exc
+        return error
+
+# def! at the top level sets the global env, anywhere else it allocates
+# a slot in the current frame like the tree-walker's env.set would
+def analyze_def(ast, scope, tail, macro=False):
+    a1 = ast[1]
+    if scope.is_toplevel():
+        a2 = analyze(ast[2], scope)
+        genv = scope.genv
+        if macro: return lambda f: define(genv, a1, _macro(a2(f)))
+        else:     return lambda f: define(genv, a1, a2(f))
+    idx = scope.reserve(a1)
+    a2 = analyze(ast[2], scope)
+    scope.bind(a1, idx)
+    late = scope.frame.late
+    def def_(f):
+        val = f[idx] = _macro(a2(f)) if macro else a2(f)
+        if late: _set_cell(f, late, idx)
+        return val
+    return def_
+
+def analyze_let(ast, scope, tail):
+    a1 = ast[1]
+    let_scope = Scope(scope)
+    start = scope.frame.size
+    binds = []
+    for i in range(0, len(a1), 2):
+        idx = let_scope.reserve(a1[i])
+        binds.append((idx, analyze(a1[i+1], let_scope)))
+        let_scope.bind(a1[i], idx)
+    body = analyze(ast[2], let_scope, tail)
+    span = (start, scope.frame.size)
+    late = scope.frame.late
+    def let(f):
+        if late: _reset_cells(f, late, span)
+        for idx, v in binds:
+            f[idx] = v(f)
+            if late: _set_cell(f, late, idx)
+        return body(f)
+    return let
+
+# loop binds its slots once and then runs its body in a while loop over
+# the same frame; recur (checked to be in tail position of the body at
+# analysis time) stores the new values in place and returns RECUR.
+# Closures capture the loop's bindings by value (late ones through a cell
+# made afresh for each iteration), so each keeps those of the iteration
+# that made it.
+# The body is always analyzed in tail position, so when the loop itself
+# is not, it runs the body's tail calls here.
+RECUR = object()
+
+def analyze_loop(ast, scope, tail):
+    a1 = ast[1]
+    loop_scope = Scope(scope)
+    span = [scope.frame.size, None]
+    binds = []
+    for i in range(0, len(a1), 2):
+        idx = loop_scope.reserve(a1[i])
+        binds.append((idx, analyze(a1[i+1], loop_scope)))
+        loop_scope.bind(a1[i], idx)
+    loop_scope.recur = ([idx for idx, v in binds], span)
+    body = analyze(ast[2], loop_scope, True)
+    span[1] = scope.frame.size
+    late = scope.frame.late
+    def loop(f):
+        if late: _reset_cells(f, late, span)
+        for idx, v in binds:
+            f[idx] = v(f)
+            if late: _set_cell(f, late, idx)
+        ret = body(f)
+        while ret is RECUR:
+            ret = body(f)
+        if not tail:
+            while type(ret) is TailCall:
+                ret = ret.body(ret.frame)
+        return ret
+    return loop
+
+def analyze_recur(ast, scope, tail):
+    target = scope.recur_target()
+    if target is None:
+        raise Exception("recur: outside of loop")
+    target, span = target
+    if not tail:
+        raise Exception("recur: not in tail position")
+    if len(ast) - 1 != len(target):
+        raise Exception("recur: expected %d arguments, got %d" %
+                        (len(target), len(ast) - 1))
+    arg_exes = [analyze(a, scope) for a in ast[1:]]
+    late = scope.frame.late
+    def recur(f):
+        vals = [a(f) for a in arg_exes]
+        if late: _reset_cells(f, late, span)
+        for idx, v in zip(target, vals):
+            f[idx] = v
+            if late: _set_cell(f, late, idx)
+        return RECUR
+    return recur
+
+def analyze_quote(ast, scope, tail):
+    a1 = ast[1]
+    return lambda f: a1
+
+def analyze_quasiquoteexpand(ast, scope, tail):
+    a1 = quasiquote(ast[1])
+    return lambda f: a1
+
+def analyze_quasiquote(ast, scope, tail):
+    return qq_analyze(ast[1], scope, tail)
+
+def analyze_defmacro(ast, scope, tail):
+    return analyze_def(ast, scope, tail, True)
+
+def analyze_macroexpand_form(ast, scope, tail):
+    a1, genv = ast[1], scope.genv
+    return lambda f: macroexpand(a1, genv)
+
+def analyze_py_bang(ast, scope, tail):
+    code = compile(ast[1], '', 'single')
+    def py_bang(f):
+        exec(code, globals())
+        return None
+    return py_bang
+
+def analyze_py(ast, scope, tail):
+    code = compile(ast[1], '', 'eval')
+    return lambda f: types.py_to_mal(eval(code, globals()))
+
+def analyze_dot(ast, scope, tail):
+    code = compile(ast[1], '', 'eval')
+    args = [analyze(a, scope) for a in ast[2:]]
+    return lambda f: eval(code, globals())(*[a(f) for a in args])
+
+def analyze_try(ast, scope, tail):
+    body = analyze(ast[1], scope)
+    if len(ast) < 3 or ast[2][0] != "catch*":
+        return body
+    a2 = ast[2]
+    start = scope.frame.size
+    catch_scope = Scope(scope, [a2[1]])
+    idx = catch_scope.names[a2[1]]
+    handler = analyze(a2[2], catch_scope, tail)
+    span = (start, scope.frame.size)
+    late = scope.frame.late
+    def try_(f):
+        try:
+            return body(f)
+        except MalException as exc:
+            err = exc.object
+        except Exception as exc:
+            err = exc.args[0]
+        if late: _reset_cells(f, late, span)
+        f[idx] = err
+        if late: _set_cell(f, late, idx)
+        return handler(f)
+    return try_
+
+def analyze_do(ast, scope, tail):
+    forms = [analyze(a, scope) for a in ast[1:-1]]
+    last = analyze(ast[-1], scope, tail)
+    def do(f):
+        for form in forms: form(f)
+        return last(f)
+    return do
+
+def analyze_if(ast, scope, tail):
+    cond = analyze(ast[1], scope)
+    then = analyze(ast[2], scope, tail)
+    els = analyze(ast[3] if len(ast) > 3 else None, scope, tail)
+    def if_(f):
+        c = cond(f)
+        if c is None or c is False: return els(f)
+        else:                       return then(f)
+    return if_
+
+def analyze_fn(ast, scope, tail):
+    a1 = ast[1]
+    rest = len(a1) > 1 and a1[-2] == "&"
+    params = [p for p in a1 if p != "&"]
+    nparams = len(params) - 1 if rest else len(params)
+    lam = Lambda(ast[2], params, nparams, rest, scope.genv)
+    syms = set()
+    body_symbols(ast[2], scope, syms)
+    syms.difference_update(params)
+    # bindings still being made (a let* binding its own closure) and any
+    # the frame makes later under these names are seen late
+    scope.frame.closure_refs.update(syms)
+    sc = scope
+    while True:
+        for s in syms:
+            if s in sc.pending: sc.make_late(sc.pending[s])
+        if sc.frame is sc: break
+        sc = sc.outer
+    def fn(f):
+        if lam.getters is None:
+            lam.captures, lam.getters = plan_captures(scope, syms)
+        return _function(lam, [g(f) for g in lam.getters])
+    return fn
+
+# Symbols a fn* body can refer to: a superset of the free variables it
+# captures. Macro calls known so far are expanded, but a head that the
+# body binds itself (a parameter or an inner let*) is not a macro there,
+# so the symbols of the unexpanded form are collected as well.
+def body_symbols(ast, scope, acc):
+    if types._symbol_Q(ast):
+        acc.add(ast)
+    elif types._list_Q(ast):
+        if len(ast) > 0 and ast[0] == u'quote':
+            return
+        try:
+            expanded = analyze_macroexpand(ast, scope)
+        except Exception:
+            expanded = ast
+        if expanded is not ast:
+            body_symbols(expanded, scope, acc)
+        for a in ast: body_symbols(a, scope, acc)
+    elif types._vector_Q(ast):
+        for a in ast: body_symbols(a, scope, acc)
+    elif types._hash_map_Q(ast):
+        for a in ast.values(): body_symbols(a, scope, acc)
+
+# Closure conversion: a closure captures the values of just the outer
+# bindings its body can see, not the defining frame, so it does not keep
+# everything else in that frame alive. The plan is made when the first
+# closure is created, once the enclosing form has been fully analyzed.
+# A binding that may change after that (made after the fn* form, like a
+# self-referencing let* or a later def!, or rebound in place by def!) is
+# captured late instead, through the Cell of its slot.
+def plan_captures(scope, syms):
+    captures, getters, positions = {}, [], {}
+    late = scope.frame.late
+    def position(key):
+        if key not in positions:
+            positions[key] = len(getters)
+            if key[0] == 'cell':   getters.append(cell_getter(*key[1:]))
+            elif key[0] == 'slot': getters.append(lambda f: f[key[1]])
+            else:                  getters.append(lambda f: f[0][key[1]])
+        return positions[key]
+    for sym in syms:
+        addr = scope.lookup(sym)
+        if addr is None:
+            continue
+        elif addr[0] == LOCAL:
+            if addr[1] in late:
+                captures[sym] = (LATE, position(('cell', addr[1], late[addr[1]])))
+            else:
+                captures[sym] = (CAPTURED, position(('slot', addr[1])))
+        else:
+            captures[sym] = (addr[0], position(('captured', addr[1])))
+    return captures, getters
+
+def cell_getter(idx, cidx):
+    def cell(f):
+        c = f[cidx]
+        if c is None:
+            c = f[cidx] = Cell(f[idx])
+        return c
+    return cell
+
+# a weak reference to fn; Python builtins that do not allow one hold no
+# frames, so a strong one will do for them
+def _ref(fn):
+    try:
+        return weakref.ref(fn)
+    except TypeError:
+        return lambda: fn
+
+# Call sites cache the last callee seen there together with its Lambda
+# (None for Python functions), so repeat calls of the same function skip
+# the macro/closure attribute probes and go straight to the frame. The
+# callee is only referenced weakly, so the cache does not keep it or
+# the values it captured alive.
+def analyze_call(ast, scope, tail):
+    f_exe = analyze(ast[0], scope)
+    arg_exes = [analyze(a, scope) for a in ast[1:]]
+    cache = [lambda: None, None]
+    # macro, macros.macro_version and analyzed expansion
+    expansion = [lambda: None, None, None]
+    def miss(fn, f):
+        if hasattr(fn, '_ismacro_'):
+            # macro defined after this form was analyzed: its expansion is
+            # analyzed once for each macro and macro_version
+            if (expansion[0]() is not fn or
+                    expansion[1] != macros.macro_version):
+                expansion[:] = [_ref(fn), macros.macro_version,
+                                analyze(fn(*ast[1:]), scope, tail)]
+            frame_scope = scope.frame
+            if len(f) < frame_scope.size:
+                f.extend([None] * (frame_scope.size - len(f)))
+            return expansion[2]
+        cache[0], cache[1] = _ref(fn), getattr(fn, '__lambda__', None)
+    def call(f):
+        fn = f_exe(f)
+        if fn is not cache[0]():
+            expanded = miss(fn, f)
+            if expanded is not None:
+                return expanded(f)
+        lam = cache[1]
+        args = [a(f) for a in arg_exes]
+        if tail and lam is not None:
+            frame = fn.__gen_frame__(args)
+            return TailCall(lam.body, frame)
+        return fn(*args)
+    if is_prim_call(ast, scope):
+        return analyze_prim(ast[0], scope.genv.data, arg_exes, call)
+    return call
+
+# Binary calls of core arithmetic/comparison through a global name run the
+# operator directly while the global binding still holds the core.ns
+# function; once user code rebinds the name they deopt to a normal call
+def is_prim_call(ast, scope):
+    return (len(ast) == 3 and types._symbol_Q(ast[0]) and
+            ast[0] in core.inline_ops and
+            scope.lookup(ast[0]) is None and not scope.genv.outer)
+
+def analyze_prim(name, data, arg_exes, call):
+    prim, op = core.ns[name], core.inline_ops[name]
+    a, b = arg_exes
+    def prim_call(f):
+        if data.get(name) is prim:
+            return op(a(f), b(f))
+        return call(f)
+    return prim_call
+
+# A form registered by host code (see forms.py) runs its (ast, env)
+# handler in an Env holding the values of the local bindings in scope
+def analyze_host_form(handler, ast, scope):
+    names, sc = set(), scope
+    while True:
+        names.update(sc.names)
+        if sc.frame is sc:
+            names.update(sc.captures)
+            break
+        sc = sc.outer
+    getters = [(k, analyze_symbol(k, scope)) for k in names]
+    genv = scope.genv
+    def host_form(f):
+        env = genv
+        if getters:
+            env = Env(genv)
+            for k, g in getters: env.data[k] = g(f)
+        ret = handler(ast, env)
+        if type(ret) is Tail:
+            return EVAL(ret.ast, ret.env)
+        return ret
+    return host_form
+
+special_forms = forms.native_forms({
+        'def!': analyze_def,
+        'let*': analyze_let,
+        'loop': analyze_loop,
+        'recur': analyze_recur,
+        'quote': analyze_quote,
+        'quasiquoteexpand': analyze_quasiquoteexpand,
+        'quasiquote': analyze_quasiquote,
+        'defmacro!': analyze_defmacro,
+        'macroexpand': analyze_macroexpand_form,
+        'py!*': analyze_py_bang,
+        'py*': analyze_py,
+        '.': analyze_dot,
+        'try*': analyze_try,
+        'do': analyze_do,
+        'if': analyze_if,
+        'fn*': analyze_fn})
+
+# Top-level `do` forms (e.g. from load-file) are analyzed one form at a
+# time so that macros defined by earlier forms apply to later ones
+def EVAL(ast, env):
+    ast = macroexpand(ast, env)
+    if types._list_Q(ast) and len(ast) > 0 and ast[0] == "do":
+        ret = None
+        for a in ast[1:]:
+            ret = EVAL(a, env)
+        return ret
+    scope = Scope(genv=env)
+    body = analyze(ast, scope, True)
+    return _run(body, [None] * scope.size)
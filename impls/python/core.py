@@ -1,5 +1,7 @@
-import copy, time
-from itertools import chain
+import operator, time
+from collections import OrderedDict
+from functools import cmp_to_key
+from itertools import chain, islice, dropwhile, takewhile, count as count_from
 
 import mal_types as types
 from mal_types import MalException, List, Vector
@@ -13,30 +15,53 @@ def throw(obj): raise MalException(obj)
 
 # String functions
 def pr_str(*args):
-    return " ".join(map(lambda exp: printer._pr_str(exp, True), args))
+    return printer._pr_join(args, True, " ")
 
 def do_str(*args):
-    return "".join(map(lambda exp: printer._pr_str(exp, False), args))
+    return printer._pr_join(args, False, "")
 
+# prn and println stream their output instead of building the whole
+# string first
 def prn(*args):
-    print(" ".join(map(lambda exp: printer._pr_str(exp, True), args)))
+    printer._pr_write(args, True)
     return None
 
 def println(*args):
-    print(" ".join(map(lambda exp: printer._pr_str(exp, False), args)))
+    printer._pr_write(args, False)
     return None
 
 
+# Reader functions
+def read_all(s): return List(reader.read_forms(s))
+
+# the forms of a file, read as the sequence is consumed
+def read_seq(filename):
+    def forms():
+        with open(filename) as stream:
+            for form in reader.read_forms(stream): yield form
+    return types.LazySeq(forms())
+
+
 # Hash map functions
+# retains metadata
 def assoc(src_hm, *key_vals):
-    hm = copy.copy(src_hm)
-    for i in range(0,len(key_vals),2): hm[key_vals[i]] = key_vals[i+1]
+    hm = src_hm
+    if types._vector_Q(hm):
+        for i in range(0,len(key_vals),2):
+            hm = hm.assoc_n(key_vals[i], key_vals[i+1])
+    else:
+        for i in range(0,len(key_vals),2):
+            hm = hm.assoc(key_vals[i], key_vals[i+1])
+    if hm is not src_hm and hasattr(src_hm, "__meta__"):
+        hm.__meta__ = src_hm.__meta__
     return hm
 
 def dissoc(src_hm, *keys):
-    hm = copy.copy(src_hm)
+    hm = src_hm
     for key in keys:
-        hm.pop(key, None)
+        hm = hm.dissoc(key)
+    if hm is not src_hm and hasattr(src_hm, "__meta__"):
+        hm.__meta__ = src_hm.__meta__
     return hm
 
 def get(hm, key):
@@ -52,49 +77,271 @@ def keys(hm): return types._list(*hm.keys())
 def vals(hm): return types._list(*hm.values())
 
 
+# Set functions
+def setf(coll): return types.Hash_Set(_elements(coll))
+
+# retains metadata
+def disj(src_set, *keys):
+    s = src_set
+    for key in keys:
+        s = s.disj(key)
+    if s is not src_set and hasattr(src_set, "__meta__"):
+        s.__meta__ = src_set.__meta__
+    return s
+
+
 # Sequence functions
 def coll_Q(coll): return sequential_Q(coll) or hash_map_Q(coll)
 
-def cons(x, seq): return List([x]) + List(seq)
+def cons(x, seq): return types.Cons(x, types._as_list(seq))
 
 def concat(*lsts): return List(chain(*lsts))
 
 def nth(lst, idx):
-    if idx < len(lst): return lst[idx]
-    else: throw("nth: index out of range")
+    # sets are not indexable: take their elements in seq order
+    if types._set_Q(lst): lst = List(lst)
+    # walk the cells consed on in front, so that a lazy tail is realized
+    # only as far as idx
+    while type(lst) == types.Cons and idx > 0:
+        lst, idx = lst.more, idx - 1
+    if type(lst) == types.Cons and idx == 0: return lst.first
+    if type(lst) == types.LazySeq:
+        lst = lst.drop(idx)
+        if lst: return lst[0]
+    elif idx < len(lst): return lst[idx]
+    throw("nth: index out of range")
 
 def first(lst):
     if types._nil_Q(lst): return None
+    elif types._set_Q(lst): return next(iter(lst), None)
     else: return lst[0]
 
 def rest(lst):
     if types._nil_Q(lst): return List([])
-    else: return List(lst[1:])
+    else: return types._rest(lst)
 
-def empty_Q(lst): return len(lst) == 0
+def empty_Q(lst): return not lst
 
 def count(lst):
     if types._nil_Q(lst): return 0
     else: return len(lst)
 
-def apply(f, *args): return f(*(list(args[0:-1])+args[-1]))
-
-def mapf(f, lst): return List(map(f, lst))
+def apply(f, *args): return f(*(list(args[0:-1])+list(args[-1])))
+
+def vec(seq):
+    if types._vector_Q(seq): return seq
+    else: return Vector(seq)
+
+# Lazy sequence functions; without a collection map, filter, take and
+# partition return the equivalent transducer. map itself stays eager (it
+# is often called for its side effects), lazy-map is the lazy version.
+# several collections are walked in step, up to the end of the shortest
+def mapf(f, *lsts):
+    if not lsts: return map_xf(f)
+    if len(lsts) == 1: return List(f(x) for x in lsts[0])
+    return List(f(*xs) for xs in _zip(*lsts))
+
+def lazy_map(f, *lsts):
+    if len(lsts) == 1: return types.LazySeq(f(x) for x in lsts[0])
+    return types.LazySeq(f(*xs) for xs in _zip(*lsts))
+
+def _one_coll(name, lsts):
+    if len(lsts) > 1: throw(name + ": takes a single collection")
+    return lsts[0]
+
+def filterf(pred, *lsts):
+    if not lsts: return filter_xf(pred)
+    lst = _one_coll("filter", lsts)
+    def matches(it):
+        for x in it:
+            keep = pred(x)
+            if keep is not None and keep is not False: yield x
+    return types.LazySeq(matches(iter(lst)))
+
+try:
+    _range = xrange
+    from itertools import izip as _zip
+except NameError:
+    _range = range
+    _zip = zip
+
+def rangef(*args):
+    if not args: return types.LazySeq(count_from())
+    return types.LazySeq(_range(*args))
+
+def take(n, *lsts):
+    if not lsts: return take_xf(n)
+    lst = _one_coll("take", lsts)
+    if lst is None: return List([])
+    return types.LazySeq(islice(lst, n))
+
+def drop(n, lst):
+    if lst is None: return List([])
+    if type(lst) == types.LazySeq: return lst.drop(n)
+    return types.LazySeq(islice(lst, n, None))
+
+def iterate(f, x):
+    def steps(x):
+        while True:
+            yield x
+            x = f(x)
+    return types.LazySeq(steps(x))
+
+def partition(n, *lsts):
+    if not lsts: return partition_xf(n)
+    def groups(it):
+        while True:
+            group = List(islice(it, n))
+            if len(group) < n: return
+            yield group
+    return types.LazySeq(groups(iter(_one_coll("partition", lsts) or ())))
+
+
+# Reducers and transducers. A reducing function rf is called as (rf) for
+# an initial value, (rf acc x) for each step and (rf acc) to complete;
+# a step may return (reduced acc) to stop early. A transducer maps a
+# reducing function to another one, so (comp xf1 xf2 ...) runs all the
+# stages in the one loop of the reduction.
+_NONE = object()
+
+def _elements(coll):
+    if coll is None: return ()
+    if types._map_Q(coll):
+        return (types._vector(k, v) for k, v in coll.items())
+    return coll
+
+def _reduce(rf, acc, coll):
+    for x in _elements(coll):
+        acc = rf(acc, x)
+        if type(acc) is types.Reduced: return acc.val
+    return acc
+
+def reducef(f, *args):
+    if len(args) == 2: return _reduce(f, args[0], args[1])
+    it = iter(_elements(args[0]))
+    for init in it:
+        return _reduce(f, init, it)
+    return f()
+
+def reduce_kv(f, init, coll):
+    if types._map_Q(coll):       items = coll.items()
+    elif types._vector_Q(coll):  items = enumerate(coll)
+    else:                        items = ()
+    acc = init
+    for k, v in items:
+        acc = f(acc, k, v)
+        if type(acc) is types.Reduced: return acc.val
+    return acc
+
+# f as a reducing function with an identity completion step
+def completing(f):
+    def rf(acc=_NONE, x=_NONE):
+        if x is not _NONE:   return f(acc, x)
+        if acc is not _NONE: return acc
+        return f()
+    return rf
+
+def transduce(xform, f, *args):
+    rf = xform(completing(f))
+    if len(args) == 2: init, coll = args
+    else:              init, coll = f(), args[0]
+    return rf(_reduce(rf, init, coll))
 
 # retains metadata
-def conj(lst, *args):
-    if types._list_Q(lst): 
-        new_lst = List(list(reversed(list(args))) + lst)
+def into(to, *args):
+    coll = args[-1]
+    xform = args[0] if len(args) == 2 else None
+    if types._vector_Q(to):  step = lambda acc, x: acc.conj(x)
+    elif types._map_Q(to):   step = lambda acc, x: acc.assoc(x[0], x[1])
+    else:                    step = conj
+    rf = completing(step)
+    if xform: rf = xform(rf)
+    if types._vector_Q(to) or types._hash_map_Q(to):
+        ret = rf(_reduce(rf, types._transient(to), coll)).persistent()
+    else:
+        ret = rf(_reduce(rf, to, coll))
+    if hasattr(to, "__meta__"):
+        ret.__meta__ = to.__meta__
+    return ret
+
+def comp(*fs):
+    if not fs: return lambda x: x
+    def composed(*args):
+        ret = fs[-1](*args)
+        for f in reversed(fs[:-1]): ret = f(ret)
+        return ret
+    return composed
+
+def map_xf(f):
+    def xf(rf):
+        def step(acc=_NONE, x=_NONE):
+            if x is not _NONE:   return rf(acc, f(x))
+            if acc is not _NONE: return rf(acc)
+            return rf()
+        return step
+    return xf
+
+def filter_xf(pred):
+    def xf(rf):
+        def step(acc=_NONE, x=_NONE):
+            if x is not _NONE:
+                keep = pred(x)
+                if keep is not None and keep is not False: return rf(acc, x)
+                return acc
+            if acc is not _NONE: return rf(acc)
+            return rf()
+        return step
+    return xf
+
+def take_xf(n):
+    def xf(rf):
+        left = [n]
+        def step(acc=_NONE, x=_NONE):
+            if x is not _NONE:
+                if left[0] <= 0: return types.Reduced(acc)
+                left[0] -= 1
+                acc = rf(acc, x)
+                if left[0] <= 0 and type(acc) is not types.Reduced:
+                    acc = types.Reduced(acc)
+                return acc
+            if acc is not _NONE: return rf(acc)
+            return rf()
+        return step
+    return xf
+
+def partition_xf(n):
+    def xf(rf):
+        buf = []
+        def step(acc=_NONE, x=_NONE):
+            if x is not _NONE:
+                buf.append(x)
+                if len(buf) < n: return acc
+                group = List(buf)
+                del buf[:]
+                return rf(acc, group)
+            if acc is not _NONE: return rf(acc)
+            return rf()
+        return step
+    return xf
+
+# retains metadata; with no arguments, the empty vector (so that conj
+# can start a reduction)
+def conj(lst=_NONE, *args):
+    if lst is _NONE: return Vector()
+    if types._list_Q(lst):
+        new_lst = lst
+        for a in args: new_lst = types.Cons(a, new_lst)
     else:
-        new_lst = Vector(lst + list(args))
+        new_lst = lst
+        for a in args: new_lst = new_lst.conj(a)
     if hasattr(lst, "__meta__"):
         new_lst.__meta__ = lst.__meta__
     return new_lst
 
 def seq(obj):
     if types._list_Q(obj):
-        return obj if len(obj) > 0 else None
-    elif types._vector_Q(obj):
+        return obj if obj else None
+    elif types._vector_Q(obj) or types._set_Q(obj):
         return List(obj) if len(obj) > 0 else None
     elif types._string_Q(obj):
         return List([c for c in obj]) if len(obj) > 0 else None
@@ -102,6 +349,172 @@ def seq(obj):
         return None
     else: throw ("seq: called on non-sequence")
 
+# Transient functions
+def _check_transient(name, coll):
+    if type(coll) not in (types.TransientVector, types.TransientHashMap):
+        throw(name + ": expected a transient")
+
+def conj_BANG(coll, *args):
+    _check_transient("conj!", coll)
+    if type(coll) == types.TransientHashMap:
+        for kv in args: coll.assoc(kv[0], kv[1])
+    else:
+        for a in args: coll.conj(a)
+    return coll
+
+def assoc_BANG(coll, *key_vals):
+    _check_transient("assoc!", coll)
+    if type(coll) == types.TransientVector:
+        for i in range(0,len(key_vals),2):
+            coll.assoc_n(key_vals[i], key_vals[i+1])
+    else:
+        for i in range(0,len(key_vals),2):
+            coll.assoc(key_vals[i], key_vals[i+1])
+    return coll
+
+def dissoc_BANG(coll, *keys):
+    _check_transient("dissoc!", coll)
+    for key in keys: coll.dissoc(key)
+    return coll
+
+def persistent_BANG(coll):
+    _check_transient("persistent!", coll)
+    return coll.persistent()
+
+
+# Sorting functions
+def _sort_key(xs, *comparator):
+    if comparator:
+        return cmp_to_key(types._fn_compare(comparator[0]))
+    kinds = set(map(type, xs))
+    if len(kinds) == 1 and (int in kinds or kinds <= set(types.str_types)):
+        return None  # Python's own order agrees with compare
+    return types._compare_key
+
+def sort(*args):
+    xs = list(_elements(args[-1]))
+    xs.sort(key=_sort_key(xs, *args[:-1]))
+    return List(xs)
+
+def sort_by(keyfn, *args):
+    xs = list(_elements(args[-1]))
+    keys = [keyfn(x) for x in xs]
+    kf = _sort_key(keys, *args[:-1]) or (lambda k: k)
+    order = sorted(range(len(xs)), key=lambda i: kf(keys[i]))
+    return List(xs[i] for i in order)
+
+def sorted_map_by(f, *key_vals):
+    return types.Sorted_Map(types._pairs(key_vals), types._fn_compare(f))
+
+def sorted_set_by(f, *vals): return types.Sorted_Set(vals, types._fn_compare(f))
+
+# (subseq sc test key) or (subseq sc start-test start-key end-test end-key)
+# with tests like < <= > >=: the entries of a sorted collection whose
+# keys k pass (test (compare k key) 0). rsubseq gives them in reverse.
+def subseq(sc, *args): return _subseq(sc, args, True)
+
+def rsubseq(sc, *args): return _subseq(sc, args, False)
+
+def _subseq(sc, args, ascending):
+    cmp = sc.cmp
+    def within(test, key):
+        def ok(entry):
+            res = test(cmp(entry[0], key), 0)
+            return res is not None and res is not False
+        return ok
+    start = end = None
+    for test, key in zip(args[0::2], args[1::2]):
+        # a lower bound accepts keys after key
+        lower = test(1, 0)
+        if (lower is not None and lower is not False) == ascending:
+            start = (test, key)
+        else:
+            end = (test, key)
+    if start:
+        past = within(*start)
+        entries = dropwhile(lambda e: not past(e),
+                            sc.seq_from(start[1], ascending))
+    else:
+        entries = sc.seq_from(ascending=ascending)
+    if end:
+        entries = takewhile(within(*end), entries)
+    if types._set_Q(sc):
+        return types.LazySeq(k for k, _ in entries)
+    return types.LazySeq(types._vector(k, v) for k, v in entries)
+
+
+# Memoization
+# An argument tuple as a dict key, hashed and compared like a mal list
+class _ArgsKey(object):
+    __slots__ = ('args', 'hash')
+    def __init__(self, args):
+        self.args = args
+        self.hash = types._coll_hash(args)
+    def __hash__(self): return self.hash
+    def __eq__(self, other):
+        if len(self.args) != len(other.args): return False
+        for a, b in zip(self.args, other.args):
+            if not types._key_equal(a, b): return False
+        return True
+
+if hasattr(OrderedDict, 'move_to_end'):
+    _touch = OrderedDict.move_to_end
+else:
+    def _touch(d, key): d[key] = d.pop(key)
+
+_kw_max_size = types._keyword('max-size')
+_kw_ttl = types._keyword('ttl')
+
+# (memoize f :max-size n :ttl ms): with :max-size the least recently used
+# result is evicted once n are cached, with :ttl results expire ms
+# milliseconds after they were computed. Expired results are dropped from
+# the front of the cache as new ones are added: without :max-size it is
+# in insertion order, which is also the order they expire in.
+def memoize(f, *opts):
+    max_size = ttl = None
+    for k, v in zip(opts[0::2], opts[1::2]):
+        if k == _kw_max_size: max_size = v
+        elif k == _kw_ttl:    ttl = v / 1000.0
+        else: throw("memoize: unknown option " + printer._pr_str(k))
+    cache = OrderedDict() if max_size is not None or ttl is not None else {}
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    def memoized(*args):
+        key = _ArgsKey(args)
+        entry = cache.get(key)
+        if entry is not None:
+            if ttl is None or time.time() < entry[1]:
+                stats['hits'] += 1
+                if max_size is not None: _touch(cache, key)
+                return entry[0]
+            del cache[key]
+            stats['evictions'] += 1
+        stats['misses'] += 1
+        ret = f(*args)
+        if ttl is not None:
+            now = time.time()
+            while cache:
+                oldest = next(iter(cache))
+                if now < cache[oldest][1]: break
+                del cache[oldest]
+                stats['evictions'] += 1
+        cache[key] = (ret, ttl is not None and time.time() + ttl)
+        if max_size is not None and len(cache) > max_size:
+            cache.popitem(last=False)
+            stats['evictions'] += 1
+        return ret
+    memoized.__memo__ = (cache, stats)
+    return memoized
+
+def memo_stats(f):
+    if not hasattr(f, '__memo__'):
+        throw("memo-stats: not a memoized function")
+    cache, stats = f.__memo__
+    return types._hash_map(types._keyword('hits'), stats['hits'],
+                           types._keyword('misses'), stats['misses'],
+                           types._keyword('evictions'), stats['evictions'],
+                           types._keyword('size'), len(cache))
+
+
 # Metadata functions
 def with_meta(obj, meta):
     new_obj = types._clone(obj)
@@ -145,14 +558,16 @@ ns = {
         'println': println,
         'readline': lambda prompt: mal_readline.readline(prompt),
         'read-string': reader.read_str,
+        'read-all': read_all,
+        'read-seq': read_seq,
         'slurp': lambda file: open(file).read(),
         '<':  lambda a,b: a<b,
         '<=': lambda a,b: a<=b,
         '>':  lambda a,b: a>b,
         '>=': lambda a,b: a>=b,
-        '+':  lambda a,b: a+b,
+        '+':  lambda a=0,b=0: a+b,
         '-':  lambda a,b: a-b,
-        '*':  lambda a,b: a*b,
+        '*':  lambda a=1,b=1: a*b,
         '/':  lambda a,b: int(a/b),
         'time-ms': lambda : int(time.time() * 1000),
 
@@ -161,18 +576,32 @@ ns = {
         'vector': types._vector,
         'vector?': types._vector_Q,
         'hash-map': types._hash_map,
-        'map?': types._hash_map_Q,
+        'map?': types._map_Q,
         'assoc': assoc,
         'dissoc': dissoc,
         'get': get,
         'contains?': contains_Q,
         'keys': keys,
         'vals': vals,
+        'hash-set': types._hash_set,
+        'set': setf,
+        'set?': types._set_Q,
+        'disj': disj,
+        'compare': types._compare,
+        'sort': sort,
+        'sort-by': sort_by,
+        'sorted-map': types._sorted_map,
+        'sorted-map-by': sorted_map_by,
+        'sorted-set': types._sorted_set,
+        'sorted-set-by': sorted_set_by,
+        'sorted?': types._sorted_Q,
+        'subseq': subseq,
+        'rsubseq': rsubseq,
 
         'sequential?': types._sequential_Q,
         'cons': cons,
         'concat': concat,
-        'vec': Vector,
+        'vec': vec,
         'nth': nth,
         'first': first,
         'rest': rest,
@@ -180,10 +609,32 @@ ns = {
         'count': count,
         'apply': apply,
         'map': mapf,
+        'lazy-map': lazy_map,
+        'filter': filterf,
+        'range': rangef,
+        'take': take,
+        'drop': drop,
+        'iterate': iterate,
+        'partition': partition,
+        'reduce': reducef,
+        'reduce-kv': reduce_kv,
+        'reduced': types._reduced,
+        'reduced?': types._reduced_Q,
+        'transduce': transduce,
+        'into': into,
+        'comp': comp,
+        'memoize': memoize,
+        'memo-stats': memo_stats,
 
         'conj': conj,
         'seq': seq,
 
+        'transient': types._transient,
+        'conj!': conj_BANG,
+        'assoc!': assoc_BANG,
+        'dissoc!': dissoc_BANG,
+        'persistent!': persistent_BANG,
+
         'with-meta': with_meta,
         'meta': meta,
         'atom': types._atom,
@@ -192,3 +643,15 @@ ns = {
         'reset!': reset_BANG,
         'swap!': swap_BANG}
 
+# Binary primitives the evaluators may inline at call sites for as long
+# as the name is still bound to its ns entry: name -> equivalent operator
+inline_ops = {
+        '=':  types._equal_Q,
+        '<':  operator.lt,
+        '<=': operator.le,
+        '>':  operator.gt,
+        '>=': operator.ge,
+        '+':  operator.add,
+        '-':  operator.sub,
+        '*':  operator.mul,
+        '/':  ns['/']}
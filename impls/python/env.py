@@ -1,6 +1,8 @@
 # Environment
 
-class Env():
+class Env(object):
+    __slots__ = ('data', 'outer')
+
     def __init__(self, outer=None, binds=None, exprs=None):
         self.data = {}
         self.outer = outer or None
@@ -14,9 +16,11 @@ class Env():
                     self.data[binds[i]] = exprs[i]
 
     def find(self, key):
-        if key in self.data: return self
-        elif self.outer:     return self.outer.find(key)
-        else:                return None
+        env = self
+        while env is not None:
+            if key in env.data: return env
+            env = env.outer
+        return None
 
     def set(self, key, value):
         self.data[key] = value
@@ -26,3 +30,27 @@ class Env():
         env = self.find(key)
         if not env: raise Exception("'" + key + "' not found")
         return env.data[key]
+
+# Env of a loop form: recur rebinds names in place and re-evaluates body,
+# unless closures were made over it (captured), which keep it as it is
+class LoopEnv(Env):
+    __slots__ = ('names', 'body', 'captured')
+
+    def __init__(self, outer, names, body):
+        Env.__init__(self, outer)
+        self.names = names
+        self.body = body
+        self.captured = False
+
+    # marks the loops env is in as captured by a closure made in env
+    @staticmethod
+    def capture(env):
+        while env is not None:
+            if type(env) is LoopEnv: env.captured = True
+            env = env.outer
+
+    # a copy of this env for the next iteration
+    def renew(self):
+        env = LoopEnv(self.outer, self.names, self.body)
+        env.data.update(self.data)
+        return env
@@ -0,0 +1,34 @@
+import mal_types as types
+
+# Special forms, shared by the evaluators. Handlers are registered by
+# head symbol and called with (ast, env). They return the value of the
+# form, or a Tail to have the evaluator continue with another form in
+# tail position (TCO). Host code can add native forms with
+# special_form(name)(handler), in every evaluation mode.
+#
+# The tree-walking evaluator dispatches through special_forms itself.
+# The stack and compile evaluators keep tables of their own for the
+# core forms (registered with native_forms) and run the handlers found
+# here for any other form; registering a handler for a name that already
+# has one replaces it in those tables too.
+class Tail(object):
+    __slots__ = ('ast', 'env')
+    def __init__(self, ast, env):
+        self.ast = ast
+        self.env = env
+
+special_forms = {}
+_native = []
+
+def special_form(name):
+    def register(handler):
+        sym = types._symbol(name)
+        if sym in special_forms:
+            for forms in _native: forms.pop(sym, None)
+        special_forms[sym] = handler
+        return handler
+    return register
+
+def native_forms(forms):
+    _native.append(forms)
+    return forms
@@ -0,0 +1,101 @@
+import os, sys, pickle, types as pytypes
+import mal_types as types
+from env import Env
+import analyzer
+
+# Heap images: the global Env pickled after startup and whatever files
+# were loaded, so that later runs can start from it instead of
+# evaluating the same definitions again.
+#
+# Builtins (core.ns and the functions the step file defines) are saved
+# by name and resolved against the running interpreter when an image is
+# loaded. mal functions are saved as what they are made of: body, params
+# and closure Env (or, in compile mode, the unanalyzed fn* and its
+# captured values). They are rebuilt around the loading interpreter's
+# evaluator, so an image can be loaded under any python_EVAL mode.
+#
+# Images are pickles: loading one runs whatever code the file asks
+# pickle to, so only load images from a trusted source.
+
+_MAGIC, _VERSION = 'mal-image', 1
+
+# the persistent id of the evaluator among the builtins
+_EVAL = 0
+
+# function attributes that their constructor sets
+_made = frozenset(['__ast__', '__env__', '__params__', '__gen_env__',
+                   '__lambda__', '__captured__', '__gen_frame__'])
+
+def _reduce_function(fn, Eval):
+    d = fn.__dict__
+    if '__ast__' in d:
+        rv = (types._function,
+              (Eval, Env, d['__ast__'], d['__env__'], d['__params__']))
+    elif '__lambda__' in d:
+        rv = (analyzer._function, (d['__lambda__'], d['__captured__']))
+    else:
+        return NotImplemented
+    return rv + (dict((k, v) for k, v in d.items() if k not in _made),)
+
+if sys.version_info >= (3, 8):
+    class _Pickler(pickle.Pickler):
+        def reducer_override(self, obj):
+            if type(obj) is pytypes.FunctionType:
+                return _reduce_function(obj, self.Eval)
+            return NotImplemented
+else:
+    _Base = getattr(pickle, '_Pickler', pickle.Pickler)
+    class _Pickler(_Base):
+        dispatch = dict(_Base.dispatch)
+        def save_function(self, obj):
+            rv = _reduce_function(obj, self.Eval)
+            if rv is NotImplemented: return self.save_global(obj)
+            self.save_reduce(obj=obj, *rv)
+        dispatch[pytypes.FunctionType] = save_function
+
+class _ImagePickler(_Pickler):
+    def __init__(self, f, builtins, Eval):
+        _Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.ids = dict((id(v), k) for k, v in builtins.items())
+        self.ids[id(Eval)] = _EVAL
+        self.Eval = Eval
+
+    def persistent_id(self, obj):
+        return self.ids.get(id(obj))
+
+class _ImageUnpickler(pickle.Unpickler):
+    def __init__(self, f, builtins, Eval):
+        pickle.Unpickler.__init__(self, f)
+        self.builtins, self.Eval = builtins, Eval
+
+    def persistent_load(self, pid):
+        if pid == _EVAL: return self.Eval
+        if pid not in self.builtins:
+            raise Exception("image: no builtin '%s' to restore" % pid)
+        return self.builtins[pid]
+
+# Writes env to the image file path. builtins maps names to the
+# functions that are saved by name, Eval is the evaluator that mal
+# functions are made with.
+def dump(path, env, builtins, Eval):
+    f = open(path, 'wb')
+    try:
+        pickle.dump((_MAGIC, _VERSION, sys.version_info[0]), f)
+        _ImagePickler(f, builtins, Eval).dump(env)
+        f.close()
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        f.close()
+        os.remove(path)
+        raise Exception("dump-image: %s" % e)
+
+# The Env saved in the image file path
+def load(path, builtins, Eval):
+    with open(path, 'rb') as f:
+        try:
+            header = pickle.load(f)
+        except Exception:
+            header = None
+        if header != (_MAGIC, _VERSION, sys.version_info[0]):
+            raise Exception("image: '%s' is not an image for this "
+                            "interpreter" % path)
+        return _ImageUnpickler(f, builtins, Eval).load()
@@ -0,0 +1,55 @@
+import functools
+import mal_types as types
+
+# quasiquote and macro expansion, shared by the evaluators
+
+# quasiquote
+def qq_loop(acc, elt):
+    if types._list_Q(elt) and len(elt) == 2 and elt[0] == u'splice-unquote':
+        return types._list(types._symbol(u'concat'), elt[1], acc)
+    else:
+        return types._list(types._symbol(u'cons'), quasiquote(elt), acc)
+
+def qq_foldr(seq):
+    return functools.reduce(qq_loop, reversed(seq), types._list())
+
+def quasiquote(ast):
+    if types._list_Q(ast):
+        if len(ast) == 2 and ast[0] == u'unquote':
+            return ast[1]
+        else:
+            return qq_foldr(ast)
+    elif types._hash_map_Q(ast) or types._symbol_Q(ast):
+        return types._list(types._symbol(u'quote'), ast)
+    elif types._vector_Q (ast):
+        return types._list(types._symbol(u'vec'), qq_foldr(ast))
+    else:
+        return ast
+
+def unquote_Q(ast, sym):
+    return types._list_Q(ast) and len(ast) == 2 and ast[0] == sym
+
+# macros
+# Every defmacro!, and any def! that binds or replaces a macro, bumps
+# macro_version, so that evaluators keeping expansions (or code analyzed
+# from them) can tell when theirs are out of date
+macro_version = 0
+
+def define(env, key, value):
+    global macro_version
+    if (hasattr(value, '_ismacro_') or
+            (env.find(key) and hasattr(env.get(key), '_ismacro_'))):
+        macro_version += 1
+    return env.set(key, value)
+
+def is_macro_call(ast, env):
+    return (types._list_Q(ast) and
+            types._symbol_Q(ast[0]) and
+            env.find(ast[0]) and
+            hasattr(env.get(ast[0]), '_ismacro_'))
+
+def macroexpand(ast, env):
+    while is_macro_call(ast, env):
+        mac = env.get(ast[0])
+        ast = mac(*ast[1:])
+    return ast
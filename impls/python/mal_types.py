@@ -1,4 +1,5 @@
-import sys, copy, types as pytypes
+import sys, copy, functools, threading, weakref, types as pytypes
+from itertools import chain, islice
 
 # python 3.0 differences
 if sys.hexversion > 0x3000000:
@@ -20,22 +21,25 @@ def _equal_Q(a, b):
     ota, otb = type(a), type(b)
     if _string_Q(a) and _string_Q(b):
         return a == b
-    if not (ota == otb or (_sequential_Q(a) and _sequential_Q(b))):
+    if not (ota == otb or (_sequential_Q(a) and _sequential_Q(b)) or
+            (_map_Q(a) and _map_Q(b)) or (_set_Q(a) and _set_Q(b))):
         return False;
     if _symbol_Q(a):
         return a == b
     elif _list_Q(a) or _vector_Q(a):
         if len(a) != len(b): return False
-        for i in range(len(a)):
-            if not _equal_Q(a[i], b[i]): return False
+        for x, y in zip(a, b):
+            if not _equal_Q(x, y): return False
         return True
-    elif _hash_map_Q(a):
-        akeys = sorted(a.keys())
-        bkeys = sorted(b.keys())
-        if len(akeys) != len(bkeys): return False
-        for i in range(len(akeys)):
-            if akeys[i] != bkeys[i]: return False
-            if not _equal_Q(a[akeys[i]], b[bkeys[i]]): return False
+    elif _map_Q(a):
+        if len(a) != len(b): return False
+        for k, v in a.items():
+            if k not in b or not _equal_Q(v, b[k]): return False
+        return True
+    elif _set_Q(a):
+        if len(a) != len(b): return False
+        for x in a:
+            if x not in b: return False
         return True
     else:
         return a == b
@@ -46,16 +50,32 @@ def _clone(obj):
     #if type(obj) == type(lambda x:x):
     if type(obj) == pytypes.FunctionType:
         if obj.__code__:
-            return pytypes.FunctionType(
+            fn = pytypes.FunctionType(
                     obj.__code__, obj.__globals__, name = obj.__name__,
                     argdefs = obj.__defaults__, closure = obj.__closure__)
         else:
-            return pytypes.FunctionType(
+            fn = pytypes.FunctionType(
                     obj.func_code, obj.func_globals, name = obj.func_name,
                     argdefs = obj.func_defaults, closure = obj.func_closure)
+        # keeps what a mal function is made of (__ast__, __env__, ...)
+        fn.__dict__.update(obj.__dict__)
+        return fn
     else:
         return copy.copy(obj)
 
+# Pickling (for heap images, see image.py): collections are saved as
+# their elements and rebuilt when loaded, since their layout depends on
+# string hashes that differ from one process to the next. Cached hashes
+# and the evaluators' caches on list nodes are not saved.
+def _reduce(obj, cls, *args):
+    if hasattr(obj, '__meta__'): return (_rebuild, (cls, args, obj.__meta__))
+    return (_rebuild, (cls, args))
+
+def _rebuild(cls, args, *meta):
+    obj = cls(*args)
+    if meta: obj.__meta__ = meta[0]
+    return obj
+
 #
 # Exception type
 #
@@ -68,28 +88,47 @@ class MalException(Exception):
 def _nil_Q(exp):    return exp is None
 def _true_Q(exp):   return exp is True
 def _false_Q(exp):  return exp is False
-def _string_Q(exp):
-    if type(exp) in str_types:
-        return len(exp) == 0 or exp[0] != _u("\u029e")
-    else:
-        return False
+def _string_Q(exp): return type(exp) in str_types
 def _number_Q(exp): return type(exp) == int
 
+# Symbols and keywords are interned: while a symbol or keyword is in
+# use, every occurrence of its name is the same object, so comparing
+# them, and probing Env dicts and maps with them, mostly stops at an
+# identity check.
+_keywords = weakref.WeakValueDictionary()
+if sys.version_info[0] >= 3:
+    _symbols = weakref.WeakValueDictionary()
+else:
+    _symbols = {}  # python 2 str subclasses are not weakly referenceable
+
 # Symbols
-class Symbol(str): pass
-def _symbol(str): return Symbol(str)
+# Still a str, so Env dicts can be keyed by them
+class Symbol(str):
+    def __reduce__(self): return (_symbol, (str(self),))
+def _symbol(str):
+    sym = _symbols.get(str)
+    if sym is None:
+        sym = _symbols[str] = Symbol(str)
+    return sym
 def _symbol_Q(exp): return type(exp) == Symbol
 
 # Keywords
-# A specially prefixed string
-def _keyword(str):
-    if str[0] == _u("\u029e"): return str
-    else:                      return _u("\u029e") + str
-def _keyword_Q(exp):
-    if type(exp) in str_types:
-        return len(exp) != 0 and exp[0] == _u("\u029e")
-    else:
-        return False
+# Equal only to themselves, hashed by their printed name
+class Keyword(object):
+    __slots__ = ('name', 'hash', '__weakref__')
+    def __init__(self, name):
+        self.name = name
+        self.hash = hash(':' + name) & 0xffffffff
+    def __hash__(self): return self.hash
+    def __reduce__(self): return (_keyword, (self.name,))
+    def __repr__(self): return ':' + self.name
+def _keyword(name):
+    if type(name) is Keyword: return name
+    kw = _keywords.get(name)
+    if kw is None:
+        kw = _keywords[name] = Keyword(name)
+    return kw
+def _keyword_Q(exp): return type(exp) is Keyword
 
 # Functions
 def _function(Eval, Env, ast, env, params):
@@ -97,6 +136,8 @@ def _function(Eval, Env, ast, env, params):
         return Eval(ast, Env(env, params, List(args)))
     fn.__meta__ = None
     fn.__ast__ = ast
+    fn.__env__ = env
+    fn.__params__ = params
     fn.__gen_env__ = lambda args: Env(env, params, args)
     return fn
 def _function_Q(f):
@@ -110,29 +151,987 @@ class List(list):
         elif i >= len(self): return None
         else:                return list.__getitem__(self, i)
     def __getslice__(self, *a): return List(list.__getslice__(self, *a))
+    def __reduce__(self): return _reduce(self, List, list(self))
+
+# Lists built by cons/conj and by rest share structure with the list they
+# came from instead of copying it: a Cons is a cell holding one element
+# in front of another list, a ListView is the tail of an indexable
+# sequence from offset off on. Both count in O(1); nth walks only the
+# cells consed on in front of an array.
+class Cons(object):
+    __slots__ = ('first', 'more', 'cnt', '__meta__', '__dict__')
+    __hash__ = None
+    def __init__(self, first, more):
+        self.first = first
+        self.more = more
+        # a lazy tail is only counted on demand
+        if type(more) is LazySeq or (type(more) is Cons and more.cnt is None):
+            self.cnt = None
+        else:
+            self.cnt = 1 + len(more)
+    def __len__(self):
+        if self.cnt is None:
+            # walk down to the first counted tail, then count the cells
+            # on the way back up
+            cells, node = [], self
+            while type(node) is Cons and node.cnt is None:
+                cells.append(node)
+                node = node.more
+            n = len(node)
+            for cell in reversed(cells):
+                n += 1
+                cell.cnt = n
+        return self.cnt
+    def __bool__(self): return True
+    __nonzero__ = __bool__
+    def __getitem__(self, i):
+        if type(i) == slice: return List(list(self)[i])
+        if i < 0:
+            i += len(self)
+            if i < 0: raise IndexError("list index out of range")
+        node = self
+        while type(node) is Cons:
+            if i == 0: return node.first
+            node, i = node.more, i - 1
+        return node[i]
+    def __iter__(self):
+        node = self
+        while type(node) is Cons:
+            yield node.first
+            node = node.more
+        for x in node: yield x
+    def __reversed__(self): return reversed(list(self))
+    def __copy__(self): return Cons(self.first, self.more)
+    def __reduce__(self): return _reduce(self, List, list(self))
+
+class ListView(object):
+    __slots__ = ('arr', 'off', '__meta__', '__dict__')
+    __hash__ = None
+    def __init__(self, arr, off):
+        self.arr = arr
+        self.off = off
+    def __len__(self): return len(self.arr) - self.off
+    def __getitem__(self, i):
+        if type(i) == slice: return List(list(self)[i])
+        n = len(self.arr) - self.off
+        if i < 0:
+            i += n
+            if i < 0: raise IndexError("list index out of range")
+        if i >= n: return None
+        return self.arr[self.off + i]
+    def __iter__(self): return islice(self.arr, self.off, None)
+    def __reversed__(self): return reversed(list(self))
+    def __copy__(self): return ListView(self.arr, self.off)
+    def __reduce__(self): return _reduce(self, List, list(self))
+
+# Lazy sequences: the elements of a Python iterable, realized 32 at a
+# time into a chain of chunks and memoized there. A LazySeq is a position
+# (chunk, off) in the chain, so rest is O(1) and shares what has been
+# realized; chunks no longer reachable from any LazySeq are freed. The
+# first chunk is realized when the sequence is created (so errors in it
+# surface where the sequence is made), later ones as they are reached.
+class _Chunk(object):
+    __slots__ = ('items', 'more')
+
+    # the next chunk, None at the end; more holds the iterator until then
+    def next(self):
+        if self.more is not None and type(self.more) is not _Chunk:
+            self.more = _chunk(self.more)
+        return self.more
+
+def _chunk(it):
+    items = list(islice(it, 32))
+    if not items: return None
+    c = _Chunk()
+    c.items, c.more = items, it if len(items) == 32 else None
+    return c
+
+def _iter_chunks(chunk, off):
+    while chunk is not None:
+        for x in islice(chunk.items, off, None): yield x
+        chunk, off = chunk.next(), 0
+
+class LazySeq(object):
+    __slots__ = ('chunk', 'off', '__meta__', '__dict__')
+    __hash__ = None
+
+    def __init__(self, iterable=()):
+        self.chunk, self.off = _chunk(iter(iterable)), 0
+
+    @classmethod
+    def _make(cls, chunk, off):
+        s = object.__new__(cls)
+        s.chunk, s.off = chunk, off
+        return s
+
+    def __bool__(self): return self.chunk is not None
+    __nonzero__ = __bool__
+
+    # iterators do not hold on to the head of the sequence
+    def __iter__(self): return _iter_chunks(self.chunk, self.off)
+
+    def __len__(self):
+        n, chunk, off = 0, self.chunk, self.off
+        while chunk is not None:
+            n += len(chunk.items) - off
+            chunk, off = chunk.next(), 0
+        return n
+
+    def __getitem__(self, i):
+        if type(i) == slice: return List(list(self)[i])
+        if i < 0:
+            i += len(self)
+            if i < 0: raise IndexError("list index out of range")
+        s = self.drop(i)
+        return s.chunk.items[s.off] if s.chunk is not None else None
+
+    def __reversed__(self): return reversed(list(self))
+    def __copy__(self): return LazySeq._make(self.chunk, self.off)
+
+    # only a fully realized sequence can be saved
+    def __reduce__(self):
+        chunk = self.chunk
+        while chunk is not None:
+            if chunk.more is not None and type(chunk.more) is not _Chunk:
+                raise TypeError("cannot save an unrealized lazy sequence")
+            chunk = chunk.more
+        return _reduce(self, LazySeq, list(self))
+
+    def rest(self):
+        chunk, off = self.chunk, self.off + 1
+        if chunk is None: return List()
+        if off == len(chunk.items):
+            chunk, off = chunk.next(), 0
+            if chunk is None: return List()
+        return LazySeq._make(chunk, off)
+
+    # the sequence without its first n elements, realizing only those
+    def drop(self, n):
+        chunk, off = self.chunk, self.off
+        while chunk is not None and off + n >= len(chunk.items):
+            n -= len(chunk.items) - off
+            chunk, off = chunk.next(), 0
+        return LazySeq._make(chunk, off + n if chunk is not None else 0)
+
+list_types = (List, Cons, ListView, LazySeq)
+
 def _list(*vals): return List(vals)
-def _list_Q(exp):   return type(exp) == List
+def _list_Q(exp):   return type(exp) in list_types
+
+# the list of all but the first element of seq, sharing its structure
+def _rest(seq):
+    if type(seq) is Cons: return seq.more
+    if type(seq) is LazySeq: return seq.rest()
+    if len(seq) <= 1: return List()
+    if type(seq) is ListView: return ListView(seq.arr, seq.off + 1)
+    return ListView(seq, 1)
+
+# seq as a list (nil as the empty list) that a Cons can point to
+def _as_list(seq):
+    if seq is None: return List()
+    if type(seq) in list_types: return seq
+    return ListView(seq, 0)
 
 
 # vectors
-class Vector(list):
-    def __add__(self, rhs): return Vector(list.__add__(self, rhs))
+# Persistent vector: a 32-way trie of leaf arrays plus a tail holding the
+# last (up to 32) elements, as in Clojure. conj, nth and assoc_n copy at
+# most one path of the trie and share everything else with the original.
+class Vector(object):
+    __slots__ = ('cnt', 'shift', 'root', 'tail', '_hash_val', '__meta__')
+    __hash__ = None
+
+    def __init__(self, vals=()):
+        vals = list(vals)
+        tailoff = ((len(vals) - 1) >> 5) << 5 if vals else 0
+        level = [vals[i:i+32] for i in range(0, tailoff, 32)]
+        shift = 5
+        while len(level) > 32:
+            level = [level[i:i+32] for i in range(0, len(level), 32)]
+            shift += 5
+        self.cnt, self.shift, self.root, self.tail = (
+                len(vals), shift, level, vals[tailoff:])
+
+    @classmethod
+    def _make(cls, cnt, shift, root, tail):
+        v = object.__new__(cls)
+        v.cnt, v.shift, v.root, v.tail = cnt, shift, root, tail
+        return v
+
+    def __len__(self): return self.cnt
+
     def __getitem__(self, i):
-        if type(i) == slice: return Vector(list.__getitem__(self, i))
-        elif i >= len(self): return None
-        else:                return list.__getitem__(self, i)
-    def __getslice__(self, *a): return Vector(list.__getslice__(self, *a))
+        if type(i) == slice: return Vector(list(self)[i])
+        if i < 0:
+            i += self.cnt
+            if i < 0: raise IndexError("vector index out of range")
+        if i >= self.cnt: return None
+        if i >= self.cnt - len(self.tail): return self.tail[i & 31]
+        node, level = self.root, self.shift
+        while level > 0:
+            node = node[(i >> level) & 31]
+            level -= 5
+        return node[i & 31]
+
+    def __iter__(self):
+        return chain.from_iterable(self._leaves())
+
+    def _leaves(self):
+        def walk(node, level):
+            if level == 0:
+                yield node
+            else:
+                for child in node:
+                    for leaf in walk(child, level - 5): yield leaf
+        if self.root:
+            for leaf in walk(self.root, self.shift): yield leaf
+        yield self.tail
+
+    def __copy__(self):
+        return Vector._make(self.cnt, self.shift, self.root, self.tail)
+
+    def __reduce__(self): return _reduce(self, Vector, list(self))
+
+    def conj(self, val):
+        if len(self.tail) < 32:
+            return Vector._make(self.cnt + 1, self.shift, self.root,
+                                self.tail + [val])
+        shift, root = _push_full_tail(self.cnt, self.shift, self.root,
+                                      self.tail)
+        return Vector._make(self.cnt + 1, shift, root, [val])
+
+    def assoc_n(self, i, val):
+        if i == self.cnt: return self.conj(val)
+        if not 0 <= i < self.cnt:
+            raise IndexError("vector index out of range")
+        if i >= self.cnt - len(self.tail):
+            tail = list(self.tail)
+            tail[i & 31] = val
+            return Vector._make(self.cnt, self.shift, self.root, tail)
+        return Vector._make(self.cnt, self.shift,
+                            _assoc_path(self.shift, self.root, i, val),
+                            self.tail)
+
+# Trie nodes are plain lists. The helpers below take an optional edit
+# token: nodes they create are then _EditNodes owned by it, and nodes
+# already owned by it are updated in place rather than copied (see
+# TransientVector).
+class _EditNode(list):
+    __slots__ = ('edit',)
+
+def _edit_node(node, edit):
+    if edit is None: return node
+    ret = _EditNode(node)
+    ret.edit = edit
+    return ret
+
+def _edit_copy(node, edit):
+    if edit is not None and type(node) is _EditNode and node.edit is edit:
+        return node
+    return _edit_node(list(node), edit)
+
+def _new_path(level, node, edit=None):
+    while level > 0:
+        node = _edit_node([node], edit)
+        level -= 5
+    return node
+
+# push a full tail into the trie, growing a level if the root is full too
+def _push_full_tail(cnt, shift, root, tail, edit=None):
+    if (cnt >> 5) > (1 << shift):
+        return shift + 5, _edit_node([root, _new_path(shift, tail, edit)], edit)
+    return shift, _push_tail(cnt, shift, root, tail, edit)
+
+def _push_tail(cnt, level, parent, tail, edit=None):
+    subidx = ((cnt - 1) >> level) & 31
+    ret = _edit_copy(parent, edit)
+    if level == 5:
+        node = tail
+    elif subidx < len(parent):
+        node = _push_tail(cnt, level - 5, parent[subidx], tail, edit)
+    else:
+        node = _new_path(level - 5, tail, edit)
+    if subidx < len(ret): ret[subidx] = node
+    else:                 ret.append(node)
+    return ret
+
+def _assoc_path(level, node, i, val, edit=None):
+    ret = _edit_copy(node, edit)
+    if level == 0:
+        ret[i & 31] = val
+    else:
+        subidx = (i >> level) & 31
+        ret[subidx] = _assoc_path(level - 5, node[subidx], i, val, edit)
+    return ret
+
 def _vector(*vals): return Vector(vals)
 def _vector_Q(exp): return type(exp) == Vector
 
 # Hash maps
-class Hash_Map(dict): pass
+# Persistent hash map. The entries live in a persistent Vector in
+# insertion order (so maps print the way they were written), with None
+# left behind by dissoc until more than half are gone. A hash array
+# mapped trie indexes them: each trie node has a 32-bit bitmap of the
+# hash slots in use at its level and a dense array with one element per
+# set bit, either a (key, position) tuple or a child node; keys whose
+# 32-bit hashes are equal share a collision node. assoc and dissoc copy
+# one path of the trie and of the vector and share everything else.
+class Hash_Map(object):
+    __slots__ = ('index', 'entries', 'cnt', '_hash_val', '__meta__')
+    __hash__ = None
+
+    def __init__(self, items=()):
+        if isinstance(items, (dict, Hash_Map)): items = items.items()
+        # nodes are built in place, owned by a throwaway edit token
+        index, entries, edit = _EMPTY_NODE, [], object()
+        for k, v in items:
+            h = _hash(k)
+            pos = _node_find(index, h, k, None)
+            if pos is None:
+                index, _ = _node_assoc(index, 0, h, k, len(entries), edit)
+                entries.append((k, v))
+            else:
+                entries[pos] = (k, v)
+        self.index, self.entries, self.cnt = index, Vector(entries), len(entries)
+
+    @classmethod
+    def _make(cls, index, entries, cnt):
+        hm = object.__new__(cls)
+        hm.index, hm.entries, hm.cnt = index, entries, cnt
+        return hm
+
+    def __len__(self): return self.cnt
+
+    def __contains__(self, key):
+        return _node_find(self.index, _hash(key), key, None) is not None
+
+    def __getitem__(self, key):
+        pos = _node_find(self.index, _hash(key), key, None)
+        if pos is None: raise KeyError(key)
+        return self.entries[pos][1]
+
+    def get(self, key, default=None):
+        pos = _node_find(self.index, _hash(key), key, None)
+        if pos is None: return default
+        return self.entries[pos][1]
+
+    def items(self):  return [e for e in self.entries if e is not None]
+    def keys(self):   return [e[0] for e in self.entries if e is not None]
+    def values(self): return [e[1] for e in self.entries if e is not None]
+    def __iter__(self): return iter(self.keys())
+
+    def __copy__(self):
+        return Hash_Map._make(self.index, self.entries, self.cnt)
+
+    def __reduce__(self): return _reduce(self, Hash_Map, self.items())
+
+    def assoc(self, key, val):
+        h = _hash(key)
+        pos = _node_find(self.index, h, key, None)
+        if pos is not None:
+            if self.entries[pos][1] is val: return self
+            return Hash_Map._make(self.index,
+                                  self.entries.assoc_n(pos, (key, val)),
+                                  self.cnt)
+        index, _ = _node_assoc(self.index, 0, h, key, len(self.entries))
+        return Hash_Map._make(index, self.entries.conj((key, val)),
+                              self.cnt + 1)
+
+    def dissoc(self, key):
+        h = _hash(key)
+        pos = _node_find(self.index, h, key, None)
+        if pos is None: return self
+        if self.cnt - 1 < len(self.entries) // 2:
+            return Hash_Map(e for i, e in enumerate(self.entries)
+                            if e is not None and i != pos)
+        return Hash_Map._make(_node_dissoc(self.index, 0, h, key) or _EMPTY_NODE,
+                              self.entries.assoc_n(pos, None),
+                              self.cnt - 1)
+
+class _BitmapNode(object):
+    __slots__ = ('bitmap', 'array', 'edit')
+    def __init__(self, bitmap, array, edit=None):
+        self.bitmap = bitmap
+        self.array = array
+        self.edit = edit
+
+class _CollisionNode(object):
+    __slots__ = ('hash', 'entries')
+    def __init__(self, hash, entries):
+        self.hash = hash
+        self.entries = entries
+
+_EMPTY_NODE = _BitmapNode(0, [])
+
+# Keys are hashed and compared structurally, consistently with _equal_Q,
+# so any mal value can be a map key or set element: lists and vectors
+# with equal elements hash alike, maps and sets combine their elements'
+# hashes independently of order. A collection's hash is computed the
+# first time it is needed and cached on the value.
+_plain_types = frozenset(str_types + [int, bool, Symbol, Keyword, type(None)])
+if sys.version_info[0] < 3: _plain_types |= frozenset([long])
+
+def _hash(key):
+    t = type(key)
+    if t is Keyword: return key.hash
+    if t in _plain_types: return hash(key) & 0xffffffff
+    if t in _coll_types:
+        h = getattr(key, '_hash_val', None)
+        if h is None: h = key._hash_val = _coll_hash(key)
+        return h
+    return hash(key) & 0xffffffff
+
+def _coll_hash(coll):
+    if _map_Q(coll):
+        h = 0x2a17
+        for k, v in coll.items(): h += _hash(k) ^ (_hash(v) * 31)
+    elif _set_Q(coll):
+        h = 0x5e7
+        for x in coll: h += _hash(x)
+    else:
+        h = 1
+        for x in coll: h = (31 * h + _hash(x)) & 0xffffffff
+    return h & 0xffffffff
+
+def _key_equal(a, b):
+    t = type(a)
+    if t is type(b) and t in _plain_types: return a == b
+    return _equal_Q(a, b)
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    _popcount = lambda n: bin(n).count('1')
+
+def _node_find(node, h, key, default):
+    shift = 0
+    while type(node) is _BitmapNode:
+        bit = 1 << ((h >> shift) & 31)
+        if not node.bitmap & bit: return default
+        item = node.array[_popcount(node.bitmap & (bit - 1))]
+        if type(item) is tuple:
+            if item[0] is key or _key_equal(item[0], key): return item[1]
+            return default
+        node, shift = item, shift + 5
+    for k, v in node.entries:
+        if _key_equal(k, key): return v
+    return default
+
+# bitmap nodes owned by edit are updated in place, others are copied
+def _editable(node, edit):
+    if edit is not None and node.edit is edit: return node
+    return _BitmapNode(node.bitmap, list(node.array), edit)
+
+# returns the new node and whether the key was added rather than replaced
+def _node_assoc(node, shift, h, key, val, edit=None):
+    if type(node) is _CollisionNode:
+        if node.hash == h:
+            entries = [e for e in node.entries if not _key_equal(e[0], key)]
+            added = len(entries) == len(node.entries)
+            return _CollisionNode(h, entries + [(key, val)]), added
+        # hash differs: nest the collision node in a bitmap node
+        node = _BitmapNode(1 << ((node.hash >> shift) & 31), [node], edit)
+    bit = 1 << ((h >> shift) & 31)
+    idx = _popcount(node.bitmap & (bit - 1))
+    if not node.bitmap & bit:
+        node = _editable(node, edit)
+        node.array.insert(idx, (key, val))
+        node.bitmap |= bit
+        return node, True
+    item = node.array[idx]
+    if type(item) is tuple:
+        if item[0] is key or _key_equal(item[0], key):
+            if item[1] is val: return node, False
+            sub, added = (key, val), False
+        else:
+            sub, added = _pair_node(shift + 5, item, h, key, val, edit), True
+    else:
+        sub, added = _node_assoc(item, shift + 5, h, key, val, edit)
+        if sub is item: return node, False
+    node = _editable(node, edit)
+    node.array[idx] = sub
+    return node, added
+
+def _pair_node(shift, entry, h, key, val, edit):
+    h1 = _hash(entry[0])
+    if h1 == h:
+        return _CollisionNode(h, [entry, (key, val)])
+    node, _ = _node_assoc(_EMPTY_NODE, shift, h1, entry[0], entry[1], edit)
+    node, _ = _node_assoc(node, shift, h, key, val, edit)
+    return node
+
+# returns the node without key, None if that leaves it empty
+def _node_dissoc(node, shift, h, key, edit=None):
+    if type(node) is _CollisionNode:
+        entries = [e for e in node.entries if not _key_equal(e[0], key)]
+        if len(entries) == len(node.entries): return node
+        return _CollisionNode(h, entries) if entries else None
+    bit = 1 << ((h >> shift) & 31)
+    if not node.bitmap & bit: return node
+    idx = _popcount(node.bitmap & (bit - 1))
+    item = node.array[idx]
+    if type(item) is tuple:
+        if not (item[0] is key or _key_equal(item[0], key)): return node
+        sub = None
+    else:
+        sub = _node_dissoc(item, shift + 5, h, key, edit)
+        if sub is item: return node
+    if sub is None and node.bitmap == bit: return None
+    node = _editable(node, edit)
+    if sub is not None:
+        node.array[idx] = sub
+    else:
+        del node.array[idx]
+        node.bitmap ^= bit
+    return node
+
+def _node_entries(node, out):
+    if type(node) is _CollisionNode:
+        out.extend(node.entries)
+        return
+    for item in node.array:
+        if type(item) is tuple: out.append(item)
+        else:                   _node_entries(item, out)
+
+# Transients: mutable editing sessions over a vector or hash-map. The
+# session's edit token owns every node created through it, so repeated
+# updates change those nodes in place; persistent! ends the session and
+# hands the nodes over to a persistent value in O(1). Only the thread
+# that started the session may use it, and only until persistent!.
+class _Edit(object):
+    __slots__ = ('owner',)
+    def __init__(self):
+        self.owner = threading.current_thread()
+
+    def check(self):
+        if self.owner is None:
+            raise Exception("transient used after persistent! call")
+        if self.owner is not threading.current_thread():
+            raise Exception("transient used by non-owner thread")
+
+class TransientVector(object):
+    __slots__ = ('cnt', 'shift', 'root', 'tail', 'edit')
+    __hash__ = None
+
+    def __init__(self, vec):
+        self.edit = _Edit()
+        self.cnt, self.shift, self.root = vec.cnt, vec.shift, vec.root
+        self.tail = _edit_node(list(vec.tail), self.edit)
+
+    def __len__(self):
+        self.edit.check()
+        return self.cnt
+
+    def __getitem__(self, i):
+        self.edit.check()
+        return Vector._make(self.cnt, self.shift, self.root, self.tail)[i]
+
+    def conj(self, val):
+        self.edit.check()
+        if len(self.tail) < 32:
+            self.tail.append(val)
+        else:
+            self.shift, self.root = _push_full_tail(
+                    self.cnt, self.shift, self.root, self.tail, self.edit)
+            self.tail = _edit_node([val], self.edit)
+        self.cnt += 1
+        return self
+
+    def assoc_n(self, i, val):
+        self.edit.check()
+        if i == self.cnt: return self.conj(val)
+        if not 0 <= i < self.cnt:
+            raise IndexError("vector index out of range")
+        if i >= self.cnt - len(self.tail):
+            self.tail[i & 31] = val
+        else:
+            self.root = _assoc_path(self.shift, self.root, i, val, self.edit)
+        return self
+
+    def persistent(self):
+        self.edit.check()
+        self.edit.owner = None
+        return Vector._make(self.cnt, self.shift, self.root, self.tail)
+
+class TransientHashMap(object):
+    __slots__ = ('index', 'entries', 'cnt', 'edit')
+    __hash__ = None
+
+    def __init__(self, hm):
+        self.edit = _Edit()
+        self.index, self.cnt = hm.index, hm.cnt
+        self.entries = TransientVector(hm.entries)
+
+    def __len__(self):
+        self.edit.check()
+        return self.cnt
+
+    def __contains__(self, key):
+        return self.get(key, _ABSENT) is not _ABSENT
+
+    def get(self, key, default=None):
+        self.edit.check()
+        pos = _node_find(self.index, _hash(key), key, None)
+        if pos is None: return default
+        return self.entries[pos][1]
+
+    def assoc(self, key, val):
+        self.edit.check()
+        h = _hash(key)
+        pos = _node_find(self.index, h, key, None)
+        if pos is not None:
+            self.entries.assoc_n(pos, (key, val))
+        else:
+            self.index, _ = _node_assoc(self.index, 0, h, key,
+                                        len(self.entries), self.edit)
+            self.entries.conj((key, val))
+            self.cnt += 1
+        return self
+
+    def dissoc(self, key):
+        self.edit.check()
+        h = _hash(key)
+        pos = _node_find(self.index, h, key, None)
+        if pos is not None:
+            self.index = (_node_dissoc(self.index, 0, h, key, self.edit)
+                          or _EMPTY_NODE)
+            self.entries.assoc_n(pos, None)
+            self.cnt -= 1
+        return self
+
+    def persistent(self):
+        self.edit.check()
+        self.edit.owner = None
+        entries = self.entries.persistent()
+        if self.cnt < len(entries) // 2:
+            return Hash_Map(e for e in entries if e is not None)
+        return Hash_Map._make(self.index, entries, self.cnt)
+
+_ABSENT = object()
+
+def _transient(coll):
+    if _vector_Q(coll):     return TransientVector(coll)
+    elif _hash_map_Q(coll): return TransientHashMap(coll)
+    raise Exception("transient: expected a vector or hash-map")
+
+# the (key, val) pairs of a key/value argument list
+def _pairs(key_vals):
+    if len(key_vals) % 2:
+        raise Exception("odd number of map arguments")
+    return zip(key_vals[0::2], key_vals[1::2])
+
 def _hash_map(*key_vals):
-    hm = Hash_Map()
-    for i in range(0,len(key_vals),2): hm[key_vals[i]] = key_vals[i+1]
-    return hm
+    return Hash_Map(_pairs(key_vals))
 def _hash_map_Q(exp): return type(exp) == Hash_Map
 
+# Sets
+# Persistent hash set: a Hash_Map from each element to itself
+class Hash_Set(object):
+    __slots__ = ('map', '_hash_val', '__meta__')
+    __hash__ = None
+
+    def __init__(self, items=()):
+        self.map = Hash_Map((x, x) for x in items)
+
+    @classmethod
+    def _make(cls, map):
+        s = object.__new__(cls)
+        s.map = map
+        return s
+
+    def __len__(self): return len(self.map)
+    def __contains__(self, key): return key in self.map
+    def __iter__(self): return iter(self.map.keys())
+    def get(self, key, default=None): return self.map.get(key, default)
+
+    def __copy__(self): return self._make(self.map)
+    def __reduce__(self): return _reduce(self, Hash_Set, list(self))
+
+    def conj(self, val):
+        if val in self.map: return self
+        return self._make(self.map.assoc(val, val))
+
+    def disj(self, key):
+        map = self.map.dissoc(key)
+        if map is self.map: return self
+        return self._make(map)
+
+def _hash_set(*vals): return Hash_Set(vals)
+
+# Sorted maps and sets
+# Persistent sorted map: an AVL tree ordered by cmp, a function returning
+# a negative number, zero or a positive number like _compare. assoc and
+# dissoc copy the path to the changed node, rebalancing it on the way up,
+# and share the rest of the tree.
+class Sorted_Map(object):
+    __slots__ = ('root', 'cnt', 'cmp', '_hash_val', '__meta__')
+    __hash__ = None
+
+    def __init__(self, items=(), cmp=None):
+        if isinstance(items, (dict, Hash_Map, Sorted_Map)): items = items.items()
+        self.root, self.cnt, self.cmp = None, 0, cmp or _compare
+        for k, v in items:
+            self.root, added = _tree_assoc(self.root, k, v, self.cmp)
+            self.cnt += added
+
+    @classmethod
+    def _make(cls, root, cnt, cmp):
+        sm = object.__new__(cls)
+        sm.root, sm.cnt, sm.cmp = root, cnt, cmp
+        return sm
+
+    def __len__(self): return self.cnt
+
+    def _find(self, key):
+        node, cmp = self.root, self.cmp
+        while node is not None:
+            c = cmp(key, node.key)
+            if c == 0: return node
+            node = node.left if c < 0 else node.right
+        return None
+
+    def __contains__(self, key): return self._find(key) is not None
+
+    def __getitem__(self, key):
+        node = self._find(key)
+        if node is None: raise KeyError(key)
+        return node.val
+
+    def get(self, key, default=None):
+        node = self._find(key)
+        if node is None: return default
+        return node.val
+
+    def items(self):  return [(n.key, n.val) for n in _tree_seq(self.root)]
+    def keys(self):   return [n.key for n in _tree_seq(self.root)]
+    def values(self): return [n.val for n in _tree_seq(self.root)]
+    def __iter__(self): return (n.key for n in _tree_seq(self.root))
+
+    # (key, val) pairs in order, or in reverse order, from the first key
+    # not before key on
+    def seq_from(self, key=_ABSENT, ascending=True):
+        cmp = None if key is _ABSENT else self.cmp
+        return ((n.key, n.val) for n in
+                _tree_seq(self.root, ascending, cmp, key))
+
+    def __copy__(self):
+        return Sorted_Map._make(self.root, self.cnt, self.cmp)
+
+    def __reduce__(self):
+        return _reduce(self, _sorted_map_from, self.items(), self.cmp)
+
+    def assoc(self, key, val):
+        root, added = _tree_assoc(self.root, key, val, self.cmp)
+        if root is self.root: return self
+        return Sorted_Map._make(root, self.cnt + added, self.cmp)
+
+    def dissoc(self, key):
+        root = _tree_dissoc(self.root, key, self.cmp)
+        if root is self.root: return self
+        return Sorted_Map._make(root, self.cnt - 1, self.cmp)
+
+class _TreeNode(object):
+    __slots__ = ('key', 'val', 'left', 'right', 'height')
+    def __init__(self, key, val, left, right):
+        self.key, self.val, self.left, self.right = key, val, left, right
+        self.height = 1 + max(left.height if left else 0,
+                              right.height if right else 0)
+
+def _height(node): return node.height if node else 0
+
+# a node for key over left and right, which may differ in height by two
+def _tree_balance(key, val, left, right):
+    hl, hr = _height(left), _height(right)
+    if hl > hr + 1:
+        if _height(left.left) >= _height(left.right):
+            return _TreeNode(left.key, left.val, left.left,
+                             _TreeNode(key, val, left.right, right))
+        lr = left.right
+        return _TreeNode(lr.key, lr.val,
+                         _TreeNode(left.key, left.val, left.left, lr.left),
+                         _TreeNode(key, val, lr.right, right))
+    if hr > hl + 1:
+        if _height(right.right) >= _height(right.left):
+            return _TreeNode(right.key, right.val,
+                             _TreeNode(key, val, left, right.left),
+                             right.right)
+        rl = right.left
+        return _TreeNode(rl.key, rl.val,
+                         _TreeNode(key, val, left, rl.left),
+                         _TreeNode(right.key, right.val, rl.right, right.right))
+    return _TreeNode(key, val, left, right)
+
+# returns the new tree and whether the key was added rather than replaced
+def _tree_assoc(node, key, val, cmp):
+    if node is None: return _TreeNode(key, val, None, None), True
+    c = cmp(key, node.key)
+    if c < 0:
+        left, added = _tree_assoc(node.left, key, val, cmp)
+        if left is node.left: return node, False
+        return _tree_balance(node.key, node.val, left, node.right), added
+    if c > 0:
+        right, added = _tree_assoc(node.right, key, val, cmp)
+        if right is node.right: return node, False
+        return _tree_balance(node.key, node.val, node.left, right), added
+    if node.val is val: return node, False
+    return _TreeNode(key, val, node.left, node.right), False
+
+def _tree_dissoc(node, key, cmp):
+    if node is None: return None
+    c = cmp(key, node.key)
+    if c < 0:
+        left = _tree_dissoc(node.left, key, cmp)
+        if left is node.left: return node
+        return _tree_balance(node.key, node.val, left, node.right)
+    if c > 0:
+        right = _tree_dissoc(node.right, key, cmp)
+        if right is node.right: return node
+        return _tree_balance(node.key, node.val, node.left, right)
+    if node.left is None: return node.right
+    if node.right is None: return node.left
+    succ = node.right
+    while succ.left is not None: succ = succ.left
+    return _tree_balance(succ.key, succ.val, node.left,
+                         _tree_remove_min(node.right))
+
+def _tree_remove_min(node):
+    if node.left is None: return node.right
+    return _tree_balance(node.key, node.val,
+                         _tree_remove_min(node.left), node.right)
+
+# a balanced tree of the (key, val) pairs items[lo:hi], which are in order
+def _tree_build(items, lo, hi):
+    if lo >= hi: return None
+    mid = (lo + hi) // 2
+    key, val = items[mid]
+    return _TreeNode(key, val, _tree_build(items, lo, mid),
+                     _tree_build(items, mid + 1, hi))
+
+# in order traversal, or reverse order if not ascending, starting at the
+# first node not before key when a cmp is given
+def _tree_seq(node, ascending=True, cmp=None, key=None):
+    stack = []
+    while node is not None:
+        if cmp is None:
+            follow = True
+        else:
+            c = cmp(key, node.key)
+            follow = c <= 0 if ascending else c >= 0
+        if follow:
+            stack.append(node)
+            node = node.left if ascending else node.right
+        else:
+            node = node.right if ascending else node.left
+    while stack:
+        node = stack.pop()
+        yield node
+        node = node.right if ascending else node.left
+        while node is not None:
+            stack.append(node)
+            node = node.left if ascending else node.right
+
+# Persistent sorted set: a Sorted_Map from each element to itself
+class Sorted_Set(Hash_Set):
+    __slots__ = ()
+
+    def __init__(self, items=(), cmp=None):
+        self.map = Sorted_Map(((x, x) for x in items), cmp)
+
+    @property
+    def cmp(self): return self.map.cmp
+
+    def __reduce__(self):
+        return _reduce(self, _sorted_set_from, list(self), self.cmp)
+
+    def seq_from(self, key=_ABSENT, ascending=True):
+        return ((k, k) for k, _ in self.map.seq_from(key, ascending))
+
+def _sorted_map(*key_vals):
+    return Sorted_Map(_pairs(key_vals))
+def _sorted_set(*vals): return Sorted_Set(vals)
+
+# Sorted collections are saved with their entries in order and rebuilt
+# without calling cmp, which may be a mal function that cannot run yet
+# while the heap image holding it is being loaded
+def _sorted_map_from(items, cmp):
+    return Sorted_Map._make(_tree_build(items, 0, len(items)), len(items), cmp)
+def _sorted_set_from(vals, cmp):
+    return Sorted_Set._make(_sorted_map_from([(x, x) for x in vals], cmp))
+def _sorted_map_Q(exp): return type(exp) == Sorted_Map
+def _sorted_Q(exp): return type(exp) in (Sorted_Map, Sorted_Set)
+def _map_Q(exp): return type(exp) in (Hash_Map, Sorted_Map)
+def _set_Q(exp): return type(exp) in (Hash_Set, Sorted_Set)
+
+_coll_types = frozenset(list(list_types) +
+                        [Vector, Hash_Map, Hash_Set, Sorted_Map, Sorted_Set])
+
+# Ordering
+# A total order over mal values consistent with _equal_Q: values of
+# different kinds order by kind, lists and vectors lexicographically,
+# maps and sets by count and then by their sorted contents. Anything
+# else (functions, atoms, ...) orders by identity.
+_ranks = {type(None): 0, bool: 1, int: 2, float: 2, Keyword: 4, Symbol: 5,
+          Hash_Map: 7, Sorted_Map: 7, Hash_Set: 8, Sorted_Set: 8}
+if sys.version_info[0] < 3: _ranks[long] = 2
+for t in str_types: _ranks[t] = 3
+for t in list(list_types) + [Vector]: _ranks[t] = 6
+
+def _compare(a, b):
+    ra, rb = _ranks.get(type(a), 9), _ranks.get(type(b), 9)
+    if ra != rb: return -1 if ra < rb else 1
+    if ra == 6 or ra == 7 or ra == 8:
+        if ra != 6:
+            if len(a) != len(b): return -1 if len(a) < len(b) else 1
+            a, b = _sorted_contents(a), _sorted_contents(b)
+        n = 0
+        for x, y in zip(a, b):
+            c = _compare(x, y)
+            if c: return c
+            n += 1
+        # one is a prefix of the other
+        return (len(a) > n) - (len(b) > n)
+    if ra == 0:
+        return 0
+    elif ra == 4:
+        a, b = a.name, b.name
+    elif ra == 9:
+        if a is b or a == b: return 0
+        a, b = id(a), id(b)
+    return (a > b) - (a < b)
+
+_compare_key = functools.cmp_to_key(_compare)
+
+def _sorted_contents(coll):
+    if _map_Q(coll):
+        items = sorted(coll.items(), key=lambda kv: _compare_key(kv[0]))
+        return list(chain.from_iterable(items))
+    return sorted(coll, key=_compare_key)
+
+# a mal comparator, returning a number or whether a is before b, as a cmp
+# (an object rather than a closure, so that sorted collections using it
+# can be pickled)
+class _FnCompare(object):
+    __slots__ = ('f',)
+    def __init__(self, f):
+        self.f = f
+    def __call__(self, a, b):
+        f = self.f
+        c = f(a, b)
+        if c is True: return -1
+        if c is False or c is None:
+            c = f(b, a)
+            return 0 if c is False or c is None else 1
+        return c
+def _fn_compare(f): return _FnCompare(f)
+
+# reduced: wraps the result of a reducing step to end the reduction early
+class Reduced(object):
+    __slots__ = ('val',)
+    def __init__(self, val):
+        self.val = val
+def _reduced(val): return Reduced(val)
+def _reduced_Q(exp): return type(exp) == Reduced
+
 # atoms
 class Atom(object):
     def __init__(self, val):
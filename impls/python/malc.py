@@ -0,0 +1,168 @@
+import os, sys, marshal, hashlib, struct
+import mal_types as types
+from mal_types import List, Vector, Hash_Map
+import reader
+
+# Parsed-form caches (.malc) for load-file. The forms of a source file
+# are stored in marshalled batches of _BATCH forms, in a cache file named
+# after the source's absolute path, behind a header with the source's
+# size, mtime and SHA-1. A cache whose size and mtime match is read without
+# looking at the source; if only the mtime differs, the content hash
+# decides. Otherwise the source is parsed and the cache rewritten while
+# its forms are being yielded.
+#
+# The cache directory is $python_MALC_DIR, by default mal-python under
+# $XDG_CACHE_HOME or ~/.cache; set python_MALC_DIR= to disable caching
+# (make test does, through python_TEST_ENV in Makefile.impls).
+
+_HEADER = struct.Struct('<4sBBBqq20s')
+_MAGIC, _VERSION = b'MALC', 1
+_BATCH = 64
+
+def _cache_dir():
+    d = os.environ.get('python_MALC_DIR')
+    if d is not None: return d or None
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'mal-python')
+
+def cache_path(path):
+    d = _cache_dir()
+    if d is None: return None
+    key = hashlib.sha1(_bytes(os.path.abspath(path))).hexdigest()
+    return os.path.join(d, '%s-py%d%d.malc' % ((key,) + sys.version_info[:2]))
+
+def _bytes(s):
+    if isinstance(s, bytes): return s
+    return s.encode('utf-8')
+
+def _mtime(st):
+    return getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+
+def _header(st, digest):
+    return _HEADER.pack(_MAGIC, _VERSION, sys.version_info[0],
+                        sys.version_info[1], st.st_size, _mtime(st), digest)
+
+# Forms as marshallable values: symbols as str, lists as lists, and
+# everything else that is not a plain int, nil or boolean as a tagged
+# tuple
+_STRING, _KEYWORD, _VECTOR, _MAP = range(4)
+
+def _encode(form):
+    t = type(form)
+    if t is types.Symbol:         return str(form)
+    elif t is List:               return list(map(_encode, form))
+    elif t is Vector:             return (_VECTOR, list(map(_encode, form)))
+    elif t is Hash_Map:
+        kvs = []
+        for k, v in form.items(): kvs.extend((_encode(k), _encode(v)))
+        return (_MAP, kvs)
+    elif t is types.Keyword:      return (_KEYWORD, form.name)
+    elif t in types.str_types:    return (_STRING, form)
+    else:                         return form
+
+# a decoding function, which interns each symbol name once
+def _decoder():
+    symbols = {}
+    def decode(val):
+        t = type(val)
+        if t is str:
+            sym = symbols.get(val)
+            if sym is None: sym = symbols[val] = types._symbol(val)
+            return sym
+        elif t is list: return List(map(decode, val))
+        elif t is tuple:
+            tag, data = val
+            if tag == _STRING:    return data
+            elif tag == _KEYWORD: return types._keyword(data)
+            elif tag == _VECTOR:  return Vector(map(decode, data))
+            else:
+                data = list(map(decode, data))
+                return Hash_Map(zip(data[0::2], data[1::2]))
+        else:           return val
+    return decode
+
+# an open cache file positioned at its first form, None if it is stale
+def _open_cache(cpath, path, st):
+    try:
+        f = open(cpath, 'rb')
+    except (IOError, OSError):
+        return None
+    header = f.read(_HEADER.size)
+    if len(header) == _HEADER.size:
+        magic, version, major, minor, size, mtime, digest = \
+                _HEADER.unpack(header)
+        if ((magic, version, major, minor) ==
+                (_MAGIC, _VERSION) + tuple(sys.version_info[:2]) and
+                size == st.st_size):
+            if mtime == _mtime(st): return f
+            with open(path) as src:
+                if hashlib.sha1(_bytes(src.read())).digest() == digest:
+                    # same content: record the new mtime
+                    try:
+                        with open(cpath, 'r+b') as u: u.write(_header(st, digest))
+                    except (IOError, OSError):
+                        pass
+                    return f
+    f.close()
+    return None
+
+# hashes what the reader reads
+class _HashingStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha1 = hashlib.sha1()
+
+    def read(self, n):
+        chunk = self.stream.read(n)
+        self.sha1.update(_bytes(chunk))
+        return chunk
+
+# Yields the forms of the file at path, from its cache when it is valid
+def read_forms(path):
+    cpath = cache_path(path)
+    st = os.stat(path)
+    cached = cpath and _open_cache(cpath, path, st)
+    if cached:
+        decode = _decoder()
+        with cached:
+            while True:
+                try:
+                    batch = marshal.load(cached)
+                except EOFError:
+                    return
+                for val in batch: yield decode(val)
+
+    out = tmp = None
+    if cpath:
+        tmp = '%s.%d.tmp' % (cpath, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cpath)):
+                os.makedirs(os.path.dirname(cpath))
+            out = open(tmp, 'wb')
+            out.write(_header(st, b'\0' * 20))
+        except (IOError, OSError):
+            out = None
+    try:
+        with open(path) as src:
+            stream = _HashingStream(src)
+            batch = []
+            for form in reader.read_forms(stream):
+                if out:
+                    batch.append(_encode(form))
+                    if len(batch) == _BATCH:
+                        marshal.dump(batch, out)
+                        batch = []
+                yield form
+        if out:
+            if batch: marshal.dump(batch, out)
+            out.seek(0)
+            out.write(_header(st, stream.sha1.digest()))
+            out.close()
+            os.rename(tmp, cpath)
+            out = None
+    finally:
+        # the file was not read to the end: drop the partial cache
+        if out:
+            out.close()
+            os.remove(tmp)
@@ -1,34 +1,92 @@
+import sys
+from itertools import chain
 import mal_types as types
 
 def _escape(s):
     return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-def _pr_str(obj, print_readably=True):
-    _r = print_readably
-    if types._list_Q(obj):
-        return "(" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + ")"
-    elif types._vector_Q(obj):                                    
-        return "[" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + "]"
-    elif types._hash_map_Q(obj):
-        ret = []
-        for k in obj.keys():
-            ret.extend((_pr_str(k), _pr_str(obj[k],_r)))
-        return "{" + " ".join(ret) + "}"
-    elif type(obj) in types.str_types:
-        if len(obj) > 0 and obj[0] == types._u('\u029e'):
-            return ':' + obj[1:]
-        elif print_readably:
-            return '"' + _escape(obj) + '"'
+# the brackets around each kind of collection
+_brackets = {types.Vector: ('[', ']'),
+             types.Hash_Map: ('{', '}'), types.Sorted_Map: ('{', '}'),
+             types.Hash_Set: ('#{', '}'), types.Sorted_Set: ('#{', '}')}
+for t in types.list_types: _brackets[t] = ('(', ')')
+_map_types = frozenset([types.Hash_Map, types.Sorted_Map])
+
+_END = object()
+
+# pieces buffered before they are written out to a stream
+_FLUSH = 4096
+
+# Appends the printed form of obj to buf piece by piece. Collections are
+# walked with an explicit stack of element iterators rather than by
+# recursion, so nesting depth is not limited by the Python stack. Given a
+# stream, buf is written to it and emptied whenever it fills up, so that
+# a large structure is never held as one string.
+def _pr_buf(obj, buf, print_readably=True, stream=None):
+    write, r, stack = buf.append, print_readably, []
+    while True:
+        t = type(obj)
+        if t in _brackets:
+            opening, closing = _brackets[t]
+            write(opening)
+            if t in _map_types:
+                stack.append([chain.from_iterable(obj.items()), closing, r, 0, True])
+            else:
+                stack.append([iter(obj), closing, r, 0, False])
+        elif t in types.str_types:
+            write('"' + _escape(obj) + '"' if r else obj)
+        elif t is types.Keyword:
+            write(':' + obj.name)
+        elif obj is None:
+            write("nil")
+        elif obj is True:
+            write("true")
+        elif obj is False:
+            write("false")
+        elif t is types.Atom:
+            write("(atom ")
+            stack.append([iter((obj.val,)), ")", r, 0, False])
         else:
-            return obj
-    elif types._nil_Q(obj):
-        return "nil"
-    elif types._true_Q(obj):
-        return "true"
-    elif types._false_Q(obj):
-        return "false"
-    elif types._atom_Q(obj):
-        return "(atom " + _pr_str(obj.val,_r) + ")"
-    else:
-        return obj.__str__()
+            write(obj.__str__())
+
+        # the next element to print, closing the collections it ends
+        while stack:
+            frame = stack[-1]
+            obj = next(frame[0], _END)
+            if obj is not _END: break
+            write(frame[1])
+            stack.pop()
+        else:
+            return
+        n = frame[3]
+        frame[3] = n + 1
+        if n: write(' ')
+        # map keys are always printed readably
+        r = True if frame[4] and not n & 1 else frame[2]
+        if stream is not None and len(buf) >= _FLUSH:
+            stream.write(''.join(buf))
+            del buf[:]
+
+def _pr_str(obj, print_readably=True):
+    buf = []
+    _pr_buf(obj, buf, print_readably)
+    return ''.join(buf)
+
+# The printed forms of objs, separated by sep
+def _pr_join(objs, print_readably=True, sep=' '):
+    buf = []
+    for i, obj in enumerate(objs):
+        if i and sep: buf.append(sep)
+        _pr_buf(obj, buf, print_readably)
+    return ''.join(buf)
 
+# Writes the printed forms of objs, separated by spaces and followed by
+# a newline, to stream (stdout by default) as they are printed
+def _pr_write(objs, print_readably=True, stream=None):
+    stream = stream or sys.stdout
+    buf = []
+    for i, obj in enumerate(objs):
+        if i: buf.append(' ')
+        _pr_buf(obj, buf, print_readably, stream)
+    buf.append('\n')
+    stream.write(''.join(buf))
@@ -1,39 +1,98 @@
-import re
-from mal_types import (_symbol, _keyword, _list, _vector, _hash_map, _s2u, _u)
+from mal_types import (_symbol, _keyword, _list, List, Vector, _hash_map, _s2u, _u,
+                       str_types)
 
 class Blank(Exception): pass
 
+# whitespace (what str.isspace accepts: the ASCII blanks here and some
+# non-ASCII ones, like U+00A0) and commas, and the characters that end a
+# symbol or number
+_blank = frozenset(' \t\n\r\f\v\x1c\x1d\x1e\x1f,')
+_delims = _blank | frozenset('[]{}()\'"`@;')
+
+# Single-pass scanner: forms are read straight out of the source string,
+# without splitting it into a token list first. Given a stream, source
+# is a buffer that is extended from the stream whenever a form runs past
+# its end.
 class Reader():
-    def __init__(self, tokens, position=0):
-        self.tokens = tokens
+    def __init__(self, source, position=0, stream=None):
+        self.source = source
         self.position = position
-
-    def next(self):
-        self.position += 1
-        return self.tokens[self.position-1]
-
+        self.stream = stream
+
+    # appends more of the stream to source, False once it is exhausted;
+    # reads grow with the buffer so that long forms take linear time
+    def more(self):
+        if self.stream is None: return False
+        chunk = self.stream.read(max(_CHUNK, len(self.source)))
+        if not chunk:
+            self.stream = None
+            return False
+        self.source += chunk
+        return True
+
+    # skips blanks and comments; the next character, '' at the end
     def peek(self):
-        if len(self.tokens) > self.position:
-            return self.tokens[self.position]
-        else:
-            return None
-
-def tokenize(str):
-    tre = re.compile(r"""[\s,]*(~@|[\[\]{}()'`~^@]|"(?:[\\].|[^\\"])*"?|;.*|[^\s\[\]{}()'"`@,;]+)""");
-    return [t for t in re.findall(tre, str) if t[0] != ';']
+        s, i, n = self.source, self.position, len(self.source)
+        while True:
+            if i >= n:
+                self.position = n
+                if not self.more(): return ''
+                s, n = self.source, len(self.source)
+            c = s[i]
+            if c in _blank or (c > '\x7f' and c.isspace()):
+                i += 1
+            elif c == ';':
+                j = s.find('\n', i)
+                while j < 0 and self.more():
+                    j = self.source.find('\n', n)
+                    s, n = self.source, len(self.source)
+                i = n if j < 0 else j
+            else:
+                self.position = i
+                return c
+
+_CHUNK = 65536
 
 def _unescape(s):
     return s.replace('\\\\', _u('\u029e')).replace('\\"', '"').replace('\\n', '\n').replace(_u('\u029e'), '\\')
 
+def read_string(reader):
+    s, start = reader.source, reader.position
+    i, q = start + 1, -1
+    while True:
+        if q < i:
+            q = s.find('"', i)
+            if q < 0:
+                if reader.more():
+                    s = reader.source
+                    continue
+                break
+        b = s.find('\\', i, q)
+        if b < 0:
+            reader.position = q + 1
+            return _s2u(_unescape(s[start+1:q]))
+        # an escape takes the next character, unless it is a newline
+        if s[b+1] == '\n': break
+        i = b + 2
+    raise Exception("expected '\"', got EOF")
+
 def read_atom(reader):
-    int_re = re.compile(r"-?[0-9]+$")
-    float_re = re.compile(r"-?[0-9][0-9.]*$")
-    string_re = re.compile(r'"(?:[\\].|[^\\"])*"')
-    token = reader.next()
-    if re.match(int_re, token):     return int(token)
-    elif re.match(float_re, token): return int(token)
-    elif re.match(string_re, token):return _s2u(_unescape(token[1:-1]))
-    elif token[0] == '"':           raise Exception("expected '\"', got EOF")
+    s, start, n = reader.source, reader.position, len(reader.source)
+    if s[start] == '"': return read_string(reader)
+    end = start + 1
+    while True:
+        while end < n:
+            c = s[end]
+            if c in _delims or (c > '\x7f' and c.isspace()): break
+            end += 1
+        if end < n or not reader.more(): break
+        s, n = reader.source, len(reader.source)
+    reader.position = end
+    token = s[start:end]
+    digits = token[1:] if token[0] == '-' else token
+    if digits and '0' <= digits[0] <= '9' and not digits.strip('0123456789.'):
+        return int(token)
+    elif token == ':':              raise Exception("expected keyword name after ':'")
     elif token[0] == ':':           return _keyword(token[1:])
     elif token == "nil":            return None
     elif token == "true":           return True
@@ -41,52 +100,51 @@ def read_atom(reader):
     else:                           return _symbol(token)
 
 def read_sequence(reader, typ=list, start='(', end=')'):
-    ast = typ()
-    token = reader.next()
-    if token != start: raise Exception("expected '" + start + "'")
+    ast = []
+    if reader.peek() != start: raise Exception("expected '" + start + "'")
+    reader.position += 1
 
     token = reader.peek()
     while token != end:
         if not token: raise Exception("expected '" + end + "', got EOF")
         ast.append(read_form(reader))
         token = reader.peek()
-    reader.next()
-    return ast
+    reader.position += 1
+    return typ(ast)
 
 def read_hash_map(reader):
     lst = read_sequence(reader, list, '{', '}')
     return _hash_map(*lst)
 
 def read_list(reader):
-    return read_sequence(reader, _list, '(', ')')
+    return read_sequence(reader, List, '(', ')')
 
 def read_vector(reader):
-    return read_sequence(reader, _vector, '[', ']')
+    return read_sequence(reader, Vector, '[', ']')
 
 def read_form(reader):
     token = reader.peek()
+    if not token: raise Exception("expected form, got EOF")
     # reader macros/transforms
-    if token[0] == ';':
-        reader.next()
-        return None
     elif token == '\'':
-        reader.next()
+        reader.position += 1
         return _list(_symbol('quote'), read_form(reader))
     elif token == '`':
-        reader.next()
+        reader.position += 1
         return _list(_symbol('quasiquote'), read_form(reader))
     elif token == '~':
-        reader.next()
+        reader.position += 1
+        if reader.position == len(reader.source): reader.more()
+        if reader.source.startswith('@', reader.position):
+            reader.position += 1
+            return _list(_symbol('splice-unquote'), read_form(reader))
         return _list(_symbol('unquote'), read_form(reader))
-    elif token == '~@':
-        reader.next()
-        return _list(_symbol('splice-unquote'), read_form(reader))
     elif token == '^':
-        reader.next()
+        reader.position += 1
         meta = read_form(reader)
         return _list(_symbol('with-meta'), read_form(reader), meta)
     elif token == '@':
-        reader.next()
+        reader.position += 1
         return _list(_symbol('deref'), read_form(reader))
 
     # list
@@ -105,6 +163,18 @@ def read_form(reader):
     else:              return read_atom(reader);
 
 def read_str(str):
-    tokens = tokenize(str)
-    if len(tokens) == 0: raise Blank("Blank Line")
-    return read_form(Reader(tokens))
+    reader = Reader(str)
+    if not reader.peek(): raise Blank("Blank Line")
+    return read_form(reader)
+
+# Yields the forms of a string or of a file-like stream one at a time,
+# each as soon as it has been read. Source already read is dropped
+# between forms, so only the form being read is held in memory.
+def read_forms(source):
+    if type(source) in str_types: reader = Reader(source)
+    else:                         reader = Reader('', 0, source)
+    while reader.peek():
+        yield read_form(reader)
+        if reader.stream is not None and reader.position >= _CHUNK:
+            reader.source = reader.source[reader.position:]
+            reader.position = 0
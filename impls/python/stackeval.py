@@ -0,0 +1,293 @@
+import mal_types as types
+from mal_types import List, Vector, Hash_Map, MalException
+from env import Env, LoopEnv
+from macros import quasiquote, macroexpand, define
+import forms
+from forms import Tail
+
+# Explicit-stack evaluator: instead of recursing through EVAL/eval_ast
+# for every non-tail subexpression, EVAL keeps its continuation on a heap
+# allocated stack of frames, so mal code can recurse as deep as memory
+# allows. Only mal functions called back from Python (map, apply, swap!,
+# macros, ...) start a nested EVAL.
+#
+# A frame is a list [kind, ast, env, ...] describing what to do with the
+# value of the subexpression currently being evaluated.
+
+ARGS, VEC, MAP, DOT, DO, IF, LET, DEF, DEFMACRO, TRY, LOOP, RECUR = range(12)
+
+# A LOOP frame stays below a loop body while it runs. recur is only in
+# tail position when that frame is on top once its arguments have been
+# evaluated; it then rebinds the loop's LoopEnv in place (or a fresh
+# copy of it, when closures were made over it) and returns the body to
+# evaluate.
+def recur(stack, vals):
+    if not stack or stack[-1][0] != LOOP:
+        if any(frame[0] == LOOP for frame in stack):
+            raise Exception("recur: not in tail position")
+        raise Exception("recur: outside of loop")
+    env = stack[-1][2]
+    if len(vals) != len(env.names):
+        raise Exception("recur: expected %d arguments, got %d" %
+                        (len(env.names), len(vals)))
+    if env.captured: env = stack[-1][2] = env.renew()
+    for k, v in zip(env.names, vals):
+        env.data[k] = v
+    return env.body, env
+
+# Special forms: handlers are called with (ast, env, stack). They push
+# the frames that wait for the values of the form's subexpressions and
+# return the form's value, or a Tail with the form to evaluate next.
+# Forms only registered in forms.special_forms (by host code) run their
+# (ast, env) handler, nested in this EVAL.
+def eval_def(ast, env, stack):
+    stack.append([DEF, ast, env])
+    return Tail(ast[2], env)
+
+def eval_let(ast, env, stack):
+    env = Env(env)
+    if len(ast[1]) == 0:
+        return Tail(ast[2], env)
+    stack.append([LET, ast, env, 0])
+    return Tail(ast[1][1], env)
+
+def eval_loop(ast, env, stack):
+    env = LoopEnv(env, ast[1][0::2], ast[2])
+    stack.append([LOOP, ast, env])
+    if len(ast[1]) == 0:
+        return Tail(ast[2], env)
+    stack.append([LET, ast, env, 0])
+    return Tail(ast[1][1], env)
+
+def eval_recur(ast, env, stack):
+    if len(ast) == 1:
+        return Tail(*recur(stack, []))
+    stack.append([RECUR, ast, env, []])
+    return Tail(ast[1], env)
+
+def eval_quote(ast, env, stack):
+    return ast[1]
+
+def eval_quasiquoteexpand(ast, env, stack):
+    return quasiquote(ast[1])
+
+def eval_quasiquote(ast, env, stack):
+    return Tail(quasiquote(ast[1]), env)
+
+def eval_defmacro(ast, env, stack):
+    stack.append([DEFMACRO, ast, env])
+    return Tail(ast[2], env)
+
+def eval_macroexpand(ast, env, stack):
+    return macroexpand(ast[1], env)
+
+def eval_py_bang(ast, env, stack):
+    exec(compile(ast[1], '', 'single'), globals())
+    return None
+
+def eval_py(ast, env, stack):
+    return types.py_to_mal(eval(ast[1]))
+
+def eval_dot(ast, env, stack):
+    if len(ast) == 2:
+        return eval(ast[1])()
+    stack.append([DOT, ast, env, []])
+    return Tail(ast[2], env)
+
+def eval_try(ast, env, stack):
+    if len(ast) > 2 and ast[2][0] == "catch*":
+        stack.append([TRY, ast, env])
+    return Tail(ast[1], env)
+
+def eval_do(ast, env, stack):
+    if len(ast) > 2:
+        stack.append([DO, ast, env, 1])
+        return Tail(ast[1], env)
+    return Tail(ast[-1], env)
+
+def eval_if(ast, env, stack):
+    stack.append([IF, ast, env])
+    return Tail(ast[1], env)
+
+def eval_fn(ast, env, stack):
+    LoopEnv.capture(env)
+    return types._function(EVAL, Env, ast[2], env, ast[1])
+
+special_forms = forms.native_forms({
+        'def!': eval_def,
+        'let*': eval_let,
+        'loop': eval_loop,
+        'recur': eval_recur,
+        'quote': eval_quote,
+        'quasiquoteexpand': eval_quasiquoteexpand,
+        'quasiquote': eval_quasiquote,
+        'defmacro!': eval_defmacro,
+        'macroexpand': eval_macroexpand,
+        'py!*': eval_py_bang,
+        'py*': eval_py,
+        '.': eval_dot,
+        'try*': eval_try,
+        'do': eval_do,
+        'if': eval_if,
+        'fn*': eval_fn})
+
+def EVAL(ast, env):
+    stack = []
+    while True:
+        try:
+            # evaluate ast in env, pushing a frame for each subexpression
+            # whose value is still needed, until a value is produced
+            while True:
+                if types._symbol_Q(ast):
+                    val = env.get(ast)
+                    break
+                elif types._vector_Q(ast):
+                    if len(ast) == 0:
+                        val = types._vector()
+                        break
+                    stack.append([VEC, ast, env, []])
+                    ast = ast[0]
+                    continue
+                elif types._hash_map_Q(ast):
+                    if len(ast) == 0:
+                        val = Hash_Map()
+                        break
+                    keys = list(ast.keys())
+                    stack.append([MAP, ast, env, keys, []])
+                    ast = ast[keys[0]]
+                    continue
+                elif not types._list_Q(ast):
+                    val = ast  # primitive value, return unchanged
+                    break
+
+                # apply list
+                ast = macroexpand(ast, env)
+                if not types._list_Q(ast):
+                    continue
+                if len(ast) == 0:
+                    val = ast
+                    break
+                a0 = ast[0]
+
+                if types._symbol_Q(a0) and a0 in special_forms:
+                    ret = special_forms[a0](ast, env, stack)
+                elif types._symbol_Q(a0) and a0 in forms.special_forms:
+                    ret = forms.special_forms[a0](ast, env)
+                else:
+                    stack.append([ARGS, ast, env, []])
+                    ast = a0
+                    continue
+                if type(ret) is not Tail:
+                    val = ret
+                    break
+                ast, env = ret.ast, ret.env
+
+            # return val to the frames waiting for it
+            while stack:
+                frame = stack[-1]
+                kind = frame[0]
+                if kind == ARGS:
+                    src, vals = frame[1], frame[3]
+                    vals.append(val)
+                    if len(vals) < len(src):
+                        ast, env = src[len(vals)], frame[2]
+                        break
+                    stack.pop()
+                    f = vals[0]
+                    if hasattr(f, '__ast__'):
+                        # a tail call ends any loop it was made from
+                        while stack and stack[-1][0] == LOOP:
+                            stack.pop()
+                        ast = f.__ast__
+                        env = f.__gen_env__(List(vals[1:]))
+                        break
+                    val = f(*vals[1:])
+                elif kind == VEC:
+                    src, vals = frame[1], frame[3]
+                    vals.append(val)
+                    if len(vals) < len(src):
+                        ast, env = src[len(vals)], frame[2]
+                        break
+                    stack.pop()
+                    val = Vector(vals)
+                elif kind == MAP:
+                    src, keys, vals = frame[1], frame[3], frame[4]
+                    vals.append(val)
+                    if len(vals) < len(keys):
+                        ast, env = src[keys[len(vals)]], frame[2]
+                        break
+                    stack.pop()
+                    val = Hash_Map(zip(keys, vals))
+                elif kind == RECUR:
+                    src, vals = frame[1], frame[3]
+                    vals.append(val)
+                    if len(vals) < len(src) - 1:
+                        ast, env = src[len(vals) + 1], frame[2]
+                        break
+                    stack.pop()
+                    ast, env = recur(stack, vals)
+                    break
+                elif kind == DOT:
+                    src, vals = frame[1], frame[3]
+                    vals.append(val)
+                    if len(vals) < len(src) - 2:
+                        ast, env = src[len(vals) + 2], frame[2]
+                        break
+                    stack.pop()
+                    val = eval(src[1])(*vals)
+                elif kind == DO:
+                    src, i = frame[1], frame[3] + 1
+                    env = frame[2]
+                    if i < len(src) - 1:
+                        frame[3] = i
+                    else:
+                        stack.pop()
+                    ast = src[i]
+                    break
+                elif kind == IF:
+                    stack.pop()
+                    src, env = frame[1], frame[2]
+                    if val is None or val is False:
+                        if len(src) > 3:
+                            ast = src[3]
+                            break
+                        val = None
+                    else:
+                        ast = src[2]
+                        break
+                elif kind == LET:
+                    src, env, i = frame[1], frame[2], frame[3]
+                    a1 = src[1]
+                    env.set(a1[i], val)
+                    i += 2
+                    if i < len(a1):
+                        frame[3] = i
+                        ast = a1[i+1]
+                    else:
+                        stack.pop()
+                        ast = src[2]
+                    break
+                elif kind == DEF:
+                    stack.pop()
+                    val = define(frame[2], frame[1][1], val)
+                elif kind == DEFMACRO:
+                    stack.pop()
+                    func = types._clone(val)
+                    func._ismacro_ = True
+                    val = define(frame[2], frame[1][1], func)
+                elif kind in (TRY, LOOP):
+                    stack.pop()
+            else:
+                return val
+        except Exception as exc:
+            # unwind to the innermost try*/catch* frame, if any
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == TRY: break
+            else:
+                raise
+            src, env = stack[i][1], stack[i][2]
+            del stack[i:]
+            if isinstance(exc, MalException): err = exc.object
+            else:                             err = exc.args[0]
+            a2 = src[2]
+            ast, env = a2[2], Env(env, [a2[1]], [err])
@@ -1,48 +1,61 @@
-import functools
-import sys, traceback
+import os, sys, traceback
 import mal_readline
 import mal_types as types
 import reader, printer
-from env import Env
+from env import Env, LoopEnv
+import macros
+from macros import quasiquote, unquote_Q, is_macro_call, define
+from forms import Tail, special_forms, special_form
 import core
+import analyzer, stackeval, malc, image
 
 # read
 def READ(str):
     return reader.read_str(str)
 
 # eval
-def qq_loop(acc, elt):
-    if types._list_Q(elt) and len(elt) == 2 and elt[0] == u'splice-unquote':
-        return types._list(types._symbol(u'concat'), elt[1], acc)
-    else:
-        return types._list(types._symbol(u'cons'), quasiquote(elt), acc)
 
-def qq_foldr(seq):
-    return functools.reduce(qq_loop, reversed(seq), types._list())
+# Quasiquote templates: each quasiquoted form is compiled once (and
+# memoized on the quasiquote node) into (kind, value) parts that are
+# instantiated directly instead of evaluating the cons/concat expansion
+QQ_CONST, QQ_UNQUOTE, QQ_SPLICE, QQ_BUILD = range(4)
 
-def quasiquote(ast):
-    if types._list_Q(ast):
-        if len(ast) == 2 and ast[0] == u'unquote':
-            return ast[1]
-        else:
-            return qq_foldr(ast)
-    elif types._hash_map_Q(ast) or types._symbol_Q(ast):
-        return types._list(types._symbol(u'quote'), ast)
-    elif types._vector_Q (ast):
-        return types._list(types._symbol(u'vec'), qq_foldr(ast))
+def qq_template(ast):
+    if unquote_Q(ast, u'unquote'):
+        return (QQ_UNQUOTE, ast[1])
+    elif types._list_Q(ast) or types._vector_Q(ast):
+        parts = [(QQ_SPLICE, elt[1]) if unquote_Q(elt, u'splice-unquote')
+                 else qq_template(elt) for elt in ast]
+        if all(kind == QQ_CONST for kind, _ in parts):
+            return (QQ_CONST, ast)
+        typ = types.List if types._list_Q(ast) else types.Vector
+        return (QQ_BUILD, (typ, parts))
     else:
-        return ast
+        return (QQ_CONST, ast)
 
-def is_macro_call(ast, env):
-    return (types._list_Q(ast) and
-            types._symbol_Q(ast[0]) and
-            env.find(ast[0]) and
-            hasattr(env.get(ast[0]), '_ismacro_'))
+def qq_instantiate(template, env):
+    typ, parts = template
+    lst = []
+    for kind, val in parts:
+        if   kind == QQ_CONST:   lst.append(val)
+        elif kind == QQ_UNQUOTE: lst.append(EVAL(val, env))
+        elif kind == QQ_SPLICE:  lst.extend(EVAL(val, env))
+        else:                    lst.append(qq_instantiate(val, env))
+    return typ(lst)
 
+# Expansions are memoized on the call-site List node along with the
+# macros.macro_version they were computed at; defmacro! and any def! that
+# binds or replaces a macro bump the version, invalidating every entry
 def macroexpand(ast, env):
+    if not types._list_Q(ast): return ast
+    cached = getattr(ast, '_expansion_', None)
+    if cached is not None and cached[0] == macros.macro_version:
+        return cached[1]
+    site, version = ast, macros.macro_version
     while is_macro_call(ast, env):
         mac = env.get(ast[0])
         ast = mac(*ast[1:])
+    site._expansion_ = (version, ast)
     return ast
 
 def eval_ast(ast, env):
@@ -57,6 +70,210 @@ def eval_ast(ast, env):
     else:
         return ast  # primitive value, return unchanged
 
+# Special forms: the handlers here are registered in forms.py's table
+# (see there), which EVAL dispatches through
+
+@special_form("def!")
+def eval_def(ast, env):
+    res = EVAL(ast[2], env)
+    return define(env, ast[1], res)
+
+@special_form("let*")
+def eval_let(ast, env):
+    a1 = ast[1]
+    let_env = Env(env)
+    for i in range(0, len(a1), 2):
+        let_env.set(a1[i], EVAL(a1[i+1], let_env))
+    return Tail(ast[2], let_env)
+
+# loop evaluates its body in a LoopEnv; recur rebinds it in place and
+# continues with the body. An iteration that made closures over the
+# LoopEnv leaves it to them and continues in a fresh one, so a closure
+# keeps the bindings of the iteration that made it. When a loop form is
+# first evaluated its body is checked so that recur only appears in tail
+# position; macro calls in it are expanded for the check (without caching
+# the expansions, as env is not the env they run in) unless their head is
+# bound inside the body.
+def check_recur(ast, env, tail=True, bound=frozenset()):
+    while is_macro_call(ast, env) and ast[0] not in bound:
+        ast = env.get(ast[0])(*ast[1:])
+    nontail = None if tail is None else False
+    if types._vector_Q(ast) or types._hash_map_Q(ast):
+        for a in (ast.values() if types._hash_map_Q(ast) else ast):
+            check_recur(a, env, nontail, bound)
+        return
+    if not types._list_Q(ast) or len(ast) == 0: return
+    a0, tails, others, inner = ast[0], [], ast, bound
+    if a0 in ("quote", "quasiquoteexpand", "macroexpand", "py!*", "py*"):
+        return
+    elif "quasiquote" == a0:
+        return check_recur(quasiquote(ast[1]), env, tail, bound)
+    elif "recur" == a0:
+        if tail is None:  raise Exception("recur: outside of loop")
+        elif not tail:    raise Exception("recur: not in tail position")
+        others = ast[1:]
+    elif a0 in ("def!", "defmacro!"):
+        others = ast[2:3]
+    elif a0 in ("let*", "loop"):
+        a1 = ast[1]
+        for i in range(0, len(a1), 2):
+            check_recur(a1[i+1], env, nontail, inner)
+            inner = inner | frozenset([a1[i]])
+        # the body of a loop is checked by that loop
+        if "let*" == a0: check_recur(ast[2], env, tail, inner)
+        return
+    elif "try*" == a0:
+        if len(ast) > 2 and ast[2][0] == "catch*":
+            check_recur(ast[2][2], env, tail, bound | frozenset([ast[2][1]]))
+        others = ast[1:2]
+    elif "do" == a0:
+        tails, others = ast[-1:], ast[1:-1]
+    elif "if" == a0:
+        tails, others = ast[2:4], ast[1:2]
+    elif "fn*" == a0:
+        params = frozenset(p for p in ast[1] if p != "&")
+        return check_recur(ast[2], env, None, bound | params)
+    for a in tails:  check_recur(a, env, tail, bound)
+    for a in others: check_recur(a, env, nontail, bound)
+
+@special_form("loop")
+def eval_loop(ast, env):
+    if getattr(ast, '_recur_checked_', None) != macros.macro_version:
+        check_recur(ast[2], env, True, frozenset(ast[1][0::2]))
+        ast._recur_checked_ = macros.macro_version
+    a1 = ast[1]
+    loop_env = LoopEnv(env, a1[0::2], ast[2])
+    for i in range(0, len(a1), 2):
+        loop_env.set(a1[i], EVAL(a1[i+1], loop_env))
+    return Tail(ast[2], loop_env)
+
+@special_form("recur")
+def eval_recur(ast, env):
+    vals = [EVAL(a, env) for a in ast[1:]]
+    while type(env) is not LoopEnv:
+        env = env.outer
+        if env is None: raise Exception("recur: outside of loop")
+    if len(vals) != len(env.names):
+        raise Exception("recur: expected %d arguments, got %d" %
+                        (len(env.names), len(vals)))
+    if env.captured: env = env.renew()
+    for k, v in zip(env.names, vals):
+        env.data[k] = v
+    return Tail(env.body, env)
+
+@special_form("quote")
+def eval_quote(ast, env):
+    return ast[1]
+
+@special_form("quasiquoteexpand")
+def eval_quasiquoteexpand(ast, env):
+    return quasiquote(ast[1])
+
+@special_form("quasiquote")
+def eval_quasiquote(ast, env):
+    template = getattr(ast, '_qq_', None)
+    if template is None:
+        template = ast._qq_ = qq_template(ast[1])
+    kind, val = template
+    if kind == QQ_CONST:
+        return val
+    elif kind == QQ_BUILD:
+        return qq_instantiate(val, env)
+    return Tail(val, env)
+
+@special_form("defmacro!")
+def eval_defmacro(ast, env):
+    func = types._clone(EVAL(ast[2], env))
+    func._ismacro_ = True
+    return define(env, ast[1], func)
+
+@special_form("macroexpand")
+def eval_macroexpand(ast, env):
+    return macroexpand(ast[1], env)
+
+@special_form("py!*")
+def eval_py_bang(ast, env):
+    exec(compile(ast[1], '', 'single'), globals())
+    return None
+
+@special_form("py*")
+def eval_py(ast, env):
+    return types.py_to_mal(eval(ast[1]))
+
+@special_form(".")
+def eval_dot(ast, env):
+    el = eval_ast(ast[2:], env)
+    f = eval(ast[1])
+    return f(*el)
+
+@special_form("try*")
+def eval_try(ast, env):
+    if len(ast) < 3:
+        return EVAL(ast[1], env)
+    a1, a2 = ast[1], ast[2]
+    if a2[0] == "catch*":
+        err = None
+        try:
+            return EVAL(a1, env)
+        except types.MalException as exc:
+            err = exc.object
+        except Exception as exc:
+            err = exc.args[0]
+        catch_env = Env(env, [a2[1]], [err])
+        return EVAL(a2[2], catch_env)
+    else:
+        return EVAL(a1, env);
+
+@special_form("do")
+def eval_do(ast, env):
+    eval_ast(ast[1:-1], env)
+    return Tail(ast[-1], env)
+
+@special_form("if")
+def eval_if(ast, env):
+    cond = EVAL(ast[1], env)
+    if cond is None or cond is False:
+        if len(ast) > 3: return Tail(ast[3], env)
+        else:            return None
+    else:
+        return Tail(ast[2], env)
+
+@special_form("fn*")
+def eval_fn(ast, env):
+    LoopEnv.capture(env)
+    return types._function(EVAL, Env, ast[2], env, ast[1])
+
+# Call-site inline caches: each call node remembers, for up to IC_SIZE
+# mal function bodies, the plan for binding their parameters, so that
+# repeat calls skip Env's generic scan of binds for "&". Entries are keyed
+# by the body and params, which all closures made by one fn* share; a
+# closure's env is read from the callee at each call, so the cache keeps
+# no callee or env alive.
+IC_SIZE = 4
+
+def call_plan(f):
+    params = f.__params__
+    if len(params) > 1 and params[-2] == "&":
+        return (f.__ast__, params, tuple(params[:-2]), params[-1])
+    else:
+        return (f.__ast__, params, tuple(params), None)
+
+# Binary calls of core arithmetic/comparison run the operator directly
+# when the head still evaluates to the core.ns function; a rebound name
+# falls through to the generic call below
+def call_site(ast):
+    prim = op = None
+    a0 = ast[0]
+    if len(ast) == 3 and types._symbol_Q(a0) and a0 in core.inline_ops:
+        prim, op = core.ns[a0], core.inline_ops[a0]
+    return (ast[1:], [], prim, op)
+
+def bind_args(env, names, rest, args):
+    for i, k in enumerate(names):
+        env.data[k] = args[i] if i < len(args) else None
+    if rest is not None:
+        env.data[rest] = types.List(args[len(names):])
+
 def EVAL(ast, env):
     while True:
         #print("EVAL %s" % printer._pr_str(ast))
@@ -70,103 +287,92 @@ def EVAL(ast, env):
         if len(ast) == 0: return ast
         a0 = ast[0]
 
-        if "def!" == a0:
-            a1, a2 = ast[1], ast[2]
-            res = EVAL(a2, env)
-            return env.set(a1, res)
-        elif "let*" == a0:
-            a1, a2 = ast[1], ast[2]
-            let_env = Env(env)
-            for i in range(0, len(a1), 2):
-                let_env.set(a1[i], EVAL(a1[i+1], let_env))
-            ast = a2
-            env = let_env
+        if types._symbol_Q(a0) and a0 in special_forms:
+            ret = special_forms[a0](ast, env)
+            if type(ret) is not Tail: return ret
+            ast, env = ret.ast, ret.env
             # Continue loop (TCO)
-        elif "quote" == a0:
-            return ast[1]
-        elif "quasiquoteexpand" == a0:
-            return quasiquote(ast[1]);
-        elif "quasiquote" == a0:
-            ast = quasiquote(ast[1]);
-            # Continue loop (TCO)
-        elif 'defmacro!' == a0:
-            func = types._clone(EVAL(ast[2], env))
-            func._ismacro_ = True
-            return env.set(ast[1], func)
-        elif 'macroexpand' == a0:
-            return macroexpand(ast[1], env)
-        elif "py!*" == a0:
-            exec(compile(ast[1], '', 'single'), globals())
-            return None
-        elif "py*" == a0:
-            return types.py_to_mal(eval(ast[1]))
-        elif "." == a0:
-            el = eval_ast(ast[2:], env)
-            f = eval(ast[1])
-            return f(*el)
-        elif "try*" == a0:
-            if len(ast) < 3:
-                return EVAL(ast[1], env)
-            a1, a2 = ast[1], ast[2]
-            if a2[0] == "catch*":
-                err = None
-                try:
-                    return EVAL(a1, env)
-                except types.MalException as exc:
-                    err = exc.object
-                except Exception as exc:
-                    err = exc.args[0]
-                catch_env = Env(env, [a2[1]], [err])
-                return EVAL(a2[2], catch_env)
+        else:
+            ic = getattr(ast, '_ic_', None)
+            if ic is None:
+                ic = ast._ic_ = call_site(ast)
+            f = EVAL(a0, env)
+            if f is ic[2] and f is not None:
+                return ic[3](EVAL(ast[1], env), EVAL(ast[2], env))
+            args = [EVAL(a, env) for a in ic[0]]
+            body = getattr(f, '__ast__', None)
+            if body is None:
+                return f(*args)
+            for plan in ic[1]:
+                if plan[0] is body and plan[1] is f.__params__: break
             else:
-                return EVAL(a1, env);
-        elif "do" == a0:
-            eval_ast(ast[1:-1], env)
-            ast = ast[-1]
-            # Continue loop (TCO)
-        elif "if" == a0:
-            a1, a2 = ast[1], ast[2]
-            cond = EVAL(a1, env)
-            if cond is None or cond is False:
-                if len(ast) > 3: ast = ast[3]
-                else:            ast = None
+                plan = call_plan(f)
+                if len(ic[1]) < IC_SIZE: ic[1].append(plan)
+            ast, _, names, rest = plan
+            env = Env(f.__env__)
+            if rest is None and len(args) == len(names):
+                env.data.update(zip(names, args))
             else:
-                ast = a2
+                bind_args(env, names, rest, args)
             # Continue loop (TCO)
-        elif "fn*" == a0:
-            a1, a2 = ast[1], ast[2]
-            return types._function(EVAL, Env, a2, env, a1)
-        else:
-            el = eval_ast(ast, env)
-            f = el[0]
-            if hasattr(f, '__ast__'):
-                ast = f.__ast__
-                env = f.__gen_env__(el[1:])
-            else:
-                return f(*el[1:])
 
 # print
 def PRINT(exp):
     return printer._pr_str(exp)
 
+# evaluation mode: "tree" re-walks the AST on every evaluation,
+# "compile" analyzes each form into Python closures once (analyzer.py),
+# "stack" keeps its continuation on the heap so deep non-tail recursion
+# does not hit Python's recursion limit (stackeval.py)
+eval_modes = {'tree': EVAL, 'compile': analyzer.EVAL, 'stack': stackeval.EVAL}
+run_eval = eval_modes[os.environ.get('python_EVAL', 'tree')]
+
 # repl
 repl_env = Env()
 def REP(str):
-    return PRINT(EVAL(READ(str), repl_env))
+    return PRINT(run_eval(READ(str), repl_env))
 
 # core.py: defined using python
 for k, v in core.ns.items(): repl_env.set(types._symbol(k), v)
-repl_env.set(types._symbol('eval'), lambda ast: EVAL(ast, repl_env))
-repl_env.set(types._symbol('*ARGV*'), types._list(*sys.argv[2:]))
+repl_env.set(types._symbol('eval'), lambda ast: run_eval(ast, repl_env))
+
+# evaluates each form of the file as soon as it has been read, reading
+# the parsed forms from the file's .malc cache when it is up to date
+def load_file(f):
+    for form in malc.read_forms(f):
+        run_eval(form, repl_env)
+    return None
+repl_env.set(types._symbol('load-file'), load_file)
 
-# core.mal: defined using the language itself
-REP("(def! *host-language* \"python\")")
-REP("(def! not (fn* (a) (if a false true)))")
-REP("(def! load-file (fn* (f) (eval (read-string (str \"(do \" (slurp f) \"\nnil)\")))))")
-REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
+# what heap images refer to by name instead of saving it
+builtins = dict((str(k), v) for k, v in repl_env.data.items())
+
+# --image FILE starts from a heap image instead of evaluating the
+# definitions below; --dump-image FILE saves one, after loading the
+# file to run if there is one, and exits. Loading an image unpickles it,
+# which can run arbitrary code: only load trusted images.
+args, image_in, image_out = sys.argv[1:], None, None
+while len(args) >= 2 and args[0] in ('--image', '--dump-image'):
+    if args[0] == '--image': image_in = args[1]
+    else:                    image_out = args[1]
+    args = args[2:]
+
+if image_in:
+    repl_env = image.load(image_in, builtins, run_eval)
+else:
+    # core.mal: defined using the language itself
+    REP("(def! *host-language* \"python\")")
+    REP("(def! not (fn* (a) (if a false true)))")
+    REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
+repl_env.set(types._symbol('*ARGV*'), types._list(*args[1:]))
+
+if image_out:
+    if args: REP('(load-file "' + args[0] + '")')
+    image.dump(image_out, repl_env, builtins, run_eval)
+    sys.exit(0)
 
-if len(sys.argv) >= 2:
-    REP('(load-file "' + sys.argv[1] + '")')
+if args:
+    REP('(load-file "' + args[0] + '")')
     sys.exit(0)
 
 # repl loop